@@ -4,7 +4,7 @@ import os
 
 import web
 
-from jhnet.app import app
+from jhnet.app import app, middleware
 
 # Ensures that web.py doesn't prefix URLs with "jhnet.py/" whenever it does a
 # redirect.
@@ -15,6 +15,6 @@ web.wsgi.runwsgi = lambda func, addr=None: web.wsgi.runfcgi(func, addr)
 
 # Start the fcgi client
 if __name__=="__main__":
-	app.run()
+	app.run(*middleware)
 
 
@@ -6,6 +6,9 @@ import deslash
 import static
 import publication
 import error
+import cache
+import stream
+import compress
 
 from mako.template import Template
 from mako.lookup   import TemplateLookup
@@ -77,12 +80,33 @@ site_menu = [
 ]
 
 
+################################################################################
+# Caches
+################################################################################
+
+# Rendered pages, shared by all handlers. Holds this many of the most recently
+# used pages.
+PAGE_CACHE_SIZE = 256
+
+page_cache = cache.LRUCache(PAGE_CACHE_SIZE)
+
+# Hit/miss statistics of the caches are written to stderr (i.e. the server's
+# error log) at most this often (in seconds).
+CACHE_STATS_INTERVAL = 60 * 60
+
+# Rendered pages are gzip compressed (once per version of the page, the result
+# being kept in the page cache) at this level if they're at least this big.
+gzip_settings = compress.GzipSettings(level = 6, min_size = 512)
+
+
 ################################################################################
 # Define Page Handlers
 ################################################################################
 
 # The homepage: Just a static page from a template
 index = static.StaticTemplate( index_template
+                             , page_cache = page_cache
+                             , gzip_settings = gzip_settings
                              , root_path = "/"
                              , site_menu = site_menu
                              )
@@ -90,6 +114,8 @@ index = static.StaticTemplate( index_template
 
 # About page: just a static page from template
 about = static.StaticTemplate( about_template
+                             , page_cache = page_cache
+                             , gzip_settings = gzip_settings
                              , root_path = "/"
                              , site_menu = site_menu
                              , site_menu_active_name = "About Me"
@@ -102,6 +128,8 @@ figures = publication.Publications( "/projects/figures"
                                   , "Figures"
                                   , pub_listing_template
                                   , pub_template
+                                  , page_cache_ = page_cache
+                                  , gzip_settings_ = gzip_settings
                                   , site_menu = site_menu
                                   , site_menu_active_name = "Projects"
                                   , root_path = "/"
@@ -113,6 +141,8 @@ projects = publication.Publications( "/projects"
                                    , "Projects"
                                    , pub_listing_template
                                    , pub_template
+                                   , page_cache_ = page_cache
+                                   , gzip_settings_ = gzip_settings
                                    , site_menu = site_menu
                                    , site_menu_active_name = "Projects"
                                    , root_path = "/"
@@ -124,6 +154,8 @@ articles = publication.Publications( "/articles"
                                    , "Articles"
                                    , pub_listing_template
                                    , pub_template
+                                   , page_cache_ = page_cache
+                                   , gzip_settings_ = gzip_settings
                                    , site_menu = site_menu
                                    , site_menu_active_name = "Articles"
                                    , root_path = "/"
@@ -133,6 +165,8 @@ articles = publication.Publications( "/articles"
 misc = static.StaticBrowseableDir( "/misc"
                                  , site_path("misc")
                                  , misc_template
+                                 , page_cache_ = page_cache
+                                 , gzip_settings_ = gzip_settings
                                  , root_path = "/"
                                  , site_menu = site_menu
                                  , site_menu_active_name = "/misc"
@@ -157,9 +191,27 @@ internal_error_handler = error.InternalError( internal_error_template
 app = web.application(urls, globals())
 app.notfound = notfound_handler
 
+# Periodically log the statistics of every cache
+app.add_processor(cache.StatsLogger([ ("pages",         page_cache)
+                                    , ("figures toc",   figures.toc_cache)
+                                    , ("projects toc",  projects.toc_cache)
+                                    , ("articles toc",  articles.toc_cache)
+                                    , ("misc listings", misc.listing_cache)
+                                    , ("misc readmes",  misc.readme_cache)
+                                    ]
+                                   , CACHE_STATS_INTERVAL
+                                   ))
+
+# WSGI middleware to run the application with
+middleware = [
+	# Hand static files to the server (where supported) rather than streaming
+	# them through Python.
+	stream.FileWrapperMiddleware,
+]
+
 if __name__ == "__main__":
 	# If running standalone, boot up the testing server
-	app.run()
+	app.run(*middleware)
 else:
 	# If running via FCGI then this is probably production, show sanitised errors
 	app.internalerror = internal_error_handler
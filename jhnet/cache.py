@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+"""
+Caches for data derived from files on disk which are automatically invalidated
+when the files change.
+"""
+
+import os
+import sys
+import time
+import threading
+
+from collections import OrderedDict
+
+
+def stat_signature(file_name):
+	"""
+	Returns a tuple which changes whenever the named file is modified or replaced
+	or None if the file does not exist.
+	"""
+	try:
+		st = os.stat(file_name)
+	except OSError:
+		return None
+	return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def stat_signatures(file_names):
+	"""
+	Returns a tuple of the stat signatures of the given files, skipping any None
+	entries in file_names.
+	"""
+	return tuple(stat_signature(f) for f in file_names if f is not None)
+
+
+class FileCache(object):
+	"""
+	A cache of values derived from files. The value for a file is produced by
+	calling loader(file_name) and is kept until the inode, size or mtime of the
+	file changes.
+	
+	The hits and misses attributes count how many lookups were served from the
+	cache and how many required the loader to be called.
+	"""
+	
+	def __init__(self, loader):
+		self.loader  = loader
+		self.entries = {}
+		self.lock    = threading.Lock()
+		
+		self.hits   = 0
+		self.misses = 0
+	
+	
+	def get(self, file_name, signature = None):
+		"""
+		Get the value for the given file, loading it if it has changed since it was
+		last loaded. Any exception raised by the loader (e.g. IOError for a missing
+		file) is passed on. If the caller has just found the file's stat signature,
+		it may be given to save another stat.
+		"""
+		if signature is None:
+			signature = stat_signature(file_name)
+		
+		with self.lock:
+			entry = self.entries.get(file_name)
+			if signature is not None and entry is not None and entry[0] == signature:
+				self.hits += 1
+				return entry[1]
+			self.misses += 1
+		
+		# Load outside the lock so that slow loads don't hold up other requests. If
+		# the file changes while loading, the signature recorded will be stale and
+		# so the value will be reloaded on the next lookup.
+		value = self.loader(file_name)
+		
+		with self.lock:
+			self.entries[file_name] = (signature, value)
+		
+		return value
+	
+	
+	def stats(self):
+		"""
+		Returns a dictionary of cache statistics.
+		"""
+		with self.lock:
+			return {
+				"entries" : len(self.entries),
+				"hits"    : self.hits,
+				"misses"  : self.misses,
+			}
+
+
+class LRUCache(object):
+	"""
+	A cache holding at most max_entries values. Once full, the least recently used
+	entry is discarded to make room for new ones.
+	
+	The hits and misses attributes count how many lookups found a value and how
+	many did not.
+	"""
+	
+	def __init__(self, max_entries):
+		self.max_entries = max_entries
+		self.entries     = OrderedDict()
+		self.lock        = threading.Lock()
+		
+		self.hits   = 0
+		self.misses = 0
+	
+	
+	def get(self, key, default = None):
+		"""
+		Get the value for the given key (marking it as recently used) or default if
+		it is not in the cache.
+		"""
+		with self.lock:
+			try:
+				value = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries[key] = value
+			self.hits += 1
+			return value
+	
+	
+	def put(self, key, value):
+		"""
+		Add a value to the cache, evicting the least recently used entry if the
+		cache is full.
+		"""
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last = False)
+	
+	
+	def stats(self):
+		"""
+		Returns a dictionary of cache statistics.
+		"""
+		with self.lock:
+			return {
+				"entries" : len(self.entries),
+				"hits"    : self.hits,
+				"misses"  : self.misses,
+			}
+
+
+class StatsLogger(object):
+	"""
+	A web.py application processor which writes the statistics of the given caches
+	(a list of (name, cache) pairs) to stderr (the server's error log under FCGI)
+	after a request when at least interval seconds have passed since they were
+	last written.
+	"""
+	
+	def __init__(self, caches, interval, stream = sys.stderr):
+		self.caches   = caches
+		self.interval = interval
+		self.stream   = stream
+		
+		self.last_logged = time.time()
+		self.lock        = threading.Lock()
+	
+	
+	def format_stats(self):
+		return "; ".join("%s: %d entries, %d hits, %d misses"%(
+		                   name, stats["entries"], stats["hits"], stats["misses"])
+		                 for name, stats in ((name, c.stats()) for name, c in self.caches))
+	
+	
+	def log(self):
+		self.stream.write("jhnet cache stats: %s\n"%self.format_stats())
+		self.stream.flush()
+	
+	
+	def __call__(self, handler):
+		try:
+			return handler()
+		finally:
+			with self.lock:
+				now = time.time()
+				due = now - self.last_logged >= self.interval
+				if due:
+					self.last_logged = now
+			if due:
+				self.log()
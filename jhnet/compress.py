@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+"""
+Content-Encoding negotiation and compressed responses.
+
+Static files may have precompressed "sidecar" versions alongside them (e.g.
+style.css.gz and style.css.br next to style.css, as generated by
+util/precompress.py) which are sent in place of the original to clients which
+accept them.
+
+Rendered pages are gzip compressed on the fly (according to a GzipSettings).
+The compressed version is kept in the page's Body so that it is only produced
+once for each version of a page.
+"""
+
+import web
+
+import zlib
+
+import cache
+
+# Default compression level (1-9) used when compressing responses on the fly
+GZIP_LEVEL = 6
+
+# By default, responses smaller than this many bytes are not worth compressing
+# on the fly
+GZIP_MIN_SIZE = 512
+
+# (Content-Encoding, file name suffix) of precompressed sidecar files, most
+# preferred first.
+SIDECARS = [
+	("br",   ".br"),
+	("gzip", ".gz"),
+]
+
+
+def accepted_encodings():
+	"""
+	Return the set of content-codings the client accepts according to its
+	Accept-Encoding header (i.e. those listed without a zero q-value).
+	"""
+	accepted = set()
+	for coding in web.ctx.env.get("HTTP_ACCEPT_ENCODING", "").split(","):
+		coding, _, params = coding.partition(";")
+		coding = coding.strip().lower()
+		if not coding:
+			continue
+		
+		q = 1.0
+		for param in params.split(";"):
+			name, _, value = param.partition("=")
+			if name.strip().lower() == "q":
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		
+		if q > 0:
+			accepted.add(coding)
+	
+	return accepted
+
+
+def find_sidecar(file_path, signature):
+	"""
+	Find the most preferred precompressed version of file_path acceptable to the
+	client. signature is the stat signature of the original file. Sidecars older
+	than the original are ignored as stale.
+	
+	Returns a (file_path, signature, encoding) tuple for the file to send, which
+	is the original (with encoding None) if no suitable sidecar exists.
+	"""
+	accepted = accepted_encodings()
+	for encoding, suffix in SIDECARS:
+		if encoding not in accepted:
+			continue
+		sidecar_signature = cache.stat_signature(file_path + suffix)
+		if sidecar_signature is not None and sidecar_signature[2] >= signature[2]:
+			return (file_path + suffix, sidecar_signature, encoding)
+	
+	return (file_path, signature, None)
+
+
+def accepts_gzip():
+	"""
+	Does the client accept gzip compressed responses?
+	"""
+	return "gzip" in accepted_encodings()
+
+
+def gzip_data(data, level = GZIP_LEVEL):
+	"""
+	Return data compressed in gzip format.
+	"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+class GzipSettings(object):
+	"""
+	How responses are compressed on the fly: at the given level (1-9) and only if
+	they are at least min_size bytes.
+	"""
+	
+	def __init__(self, level = GZIP_LEVEL, min_size = GZIP_MIN_SIZE):
+		self.level    = level
+		self.min_size = min_size
+
+
+DEFAULT_GZIP_SETTINGS = GzipSettings()
+
+
+class Body(object):
+	"""
+	A response body (as bytes) along with its gzip compressed form, which is only
+	generated when first needed.
+	"""
+	
+	def __init__(self, data, settings = DEFAULT_GZIP_SETTINGS):
+		self.data     = data
+		self.settings = settings
+		self.gzipped  = None
+	
+	
+	def gzip(self):
+		if self.gzipped is None:
+			self.gzipped = gzip_data(self.data, self.settings.level)
+		return self.gzipped
+
+
+def send(body, gzip_ok):
+	"""
+	Set the Content-Length and (if compressing) Content-Encoding headers for the
+	given Body and return the data to send. The body is sent gzip compressed if
+	gzip_ok (i.e. the client accepts it) and it is at least the minimum size given
+	by its GzipSettings. The caller is responsible for sending "Vary:
+	Accept-Encoding".
+	"""
+	if gzip_ok and len(body.data) >= body.settings.min_size:
+		web.header("Content-Encoding", "gzip")
+		data = body.gzip()
+	else:
+		data = body.data
+	
+	web.header("Content-Length", str(len(data)))
+	return data
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+"""
+Support for HTTP conditional GETs (Last-Modified, ETag and 304 Not Modified
+responses) for responses generated from files on disk.
+"""
+
+import web
+
+import hashlib
+import datetime
+
+# Cache-Control for pages which may change at any time: clients may keep a copy
+# but must check it is still current (cheaply, using the validators) before use.
+REVALIDATE = "public, no-cache"
+
+
+def validators(signatures, *extra):
+	"""
+	Returns a (last_modified, etag) pair for a response generated from files with
+	the given stat signatures (see cache.stat_signature) and from any other values
+	given in extra. last_modified is a UTC datetime (or None if none of the files
+	exist).
+	"""
+	mtimes = [signature[2] for signature in signatures if signature is not None]
+	if mtimes:
+		last_modified = datetime.datetime.utcfromtimestamp(int(max(mtimes)))
+	else:
+		last_modified = None
+	
+	etag = hashlib.sha1(repr((list(signatures), extra))).hexdigest()[:20]
+	
+	return (last_modified, etag)
+
+
+def is_current(last_modified, etag):
+	"""
+	Does the client already have the current version of the response? As in RFC
+	7232, If-Modified-Since is only considered when no If-None-Match is given.
+	(web.modified accepts a match of either.)
+	"""
+	if_none_match = web.ctx.env.get("HTTP_IF_NONE_MATCH")
+	if if_none_match is not None:
+		for tag in if_none_match.split(","):
+			tag = tag.strip()
+			if tag.startswith("W/"):
+				tag = tag[2:]
+			if tag.strip('"') in ("*", etag):
+				return True
+		return False
+	
+	if_modified_since = web.ctx.env.get("HTTP_IF_MODIFIED_SINCE")
+	if if_modified_since is not None and last_modified is not None:
+		since = web.parsehttpdate(if_modified_since.split(";")[0])
+		return since is not None and last_modified <= since
+	
+	return False
+
+
+def range_applies(last_modified, etag):
+	"""
+	Should a Range header in the request be honoured? This is the case unless an
+	If-Range header is given which does not match the current version.
+	"""
+	if_range = web.ctx.env.get("HTTP_IF_RANGE")
+	if if_range is None:
+		return True
+	
+	if_range = if_range.strip()
+	if if_range.startswith('"') or if_range.startswith("W/"):
+		# Only (strong) ETags may be used
+		return if_range == '"%s"'%etag
+	else:
+		return (last_modified is not None
+		        and web.parsehttpdate(if_range) == last_modified)
+
+
+def set_headers(last_modified, etag, cache_control):
+	"""
+	Add the validator and Cache-Control headers to the response.
+	"""
+	if last_modified is not None:
+		web.lastmodified(last_modified)
+	web.header("ETag", '"%s"'%etag)
+	web.header("Cache-Control", cache_control)
+
+
+def check(last_modified, etag, cache_control):
+	"""
+	Respond with 304 Not Modified if the client already has the current version
+	of the response. Otherwise, the caller should produce the response and then
+	call set_headers.
+	"""
+	if is_current(last_modified, etag):
+		set_headers(last_modified, etag, cache_control)
+		raise web.notmodified()
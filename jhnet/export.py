@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+"""
+Exports the whole site as static files which can be served by Apache without
+running any Python.
+
+Usage:
+
+	export.py [--full] output_dir
+	
+	Every page served by the handlers in app.py (publication listings, tag pages
+	and publications, template pages, misc directory listings and the 404 page)
+	is rendered into output_dir along with all static files and an .htaccess
+	which maps the site's URLs onto the exported files.
+	
+	Exports are incremental: a manifest of what was exported is kept in
+	output_dir/.export_manifest.json and pages are only re-rendered (using a
+	conditional GET with the ETag of the previous export) when their inputs have
+	changed. Files are only copied when their size or mtime has changed. Pages and
+	files which no longer exist are removed. With --full, everything is exported
+	regardless (e.g. after changing the code of the handlers).
+
+Pages are stored as [url].html, directory listings as [url]/index.html. As query
+strings can't be exported, misc directory listings are rendered with every entry
+on one page, in their default sort order and without sorting links. As in the
+live listings, dotfiles and READMEs are not exported.
+"""
+
+import web
+
+import os
+import sys
+import json
+import shutil
+
+import app
+import static
+import compress
+
+MANIFEST_FILE = ".export_manifest.json"
+
+# URL which is assumed not to exist, used to render the 404 page
+NOT_FOUND_URL = "/this-page-does-not-exist"
+
+HTACCESS = r"""# Generated by jhnet/export.py for a statically exported site.
+
+Order allow,deny
+Allow from all
+
+Options -Indexes -MultiViews
+DirectorySlash Off
+DirectoryIndex index.html
+ErrorDocument 404 /404.html
+
+<IfModule mod_rewrite.c>
+	RewriteEngine on
+	RewriteBase /
+	
+	# Pages are stored as [url].html
+	RewriteCond %{REQUEST_FILENAME} !-f
+	RewriteCond %{REQUEST_FILENAME}.html -f
+	RewriteRule ^(.*)$ $1.html [L]
+	
+	# Directory listings must end with a slash...
+	RewriteCond %{REQUEST_FILENAME} -d
+	RewriteCond %{REQUEST_FILENAME}/index.html -f
+	RewriteRule ^(.*[^/])$ /$1/ [R=303,L]
+	
+	# ...and nothing else should.
+	RewriteCond %{REQUEST_FILENAME}/index.html !-f
+	RewriteRule ^(.+)/$ /$1 [R=303,L]
+	
+	# Send precompressed versions of files to clients which accept them
+	<IfModule mod_headers.c>
+		RewriteCond %{HTTP:Accept-Encoding} \bgzip\b
+		RewriteCond %{REQUEST_FILENAME}.gz -f
+		RewriteRule ^(.*\.(css|js|html|svg|txt|json|xml))$ $1.gz [L]
+	</IfModule>
+</IfModule>
+
+<IfModule mod_headers.c>
+	<FilesMatch "\.(css|js|html|svg|txt|json|xml)(\.gz)?$">
+		Header append Vary Accept-Encoding
+	</FilesMatch>
+	<FilesMatch "\.(css|js|html|svg|txt|json|xml)\.gz$">
+		RemoveType .gz
+		RemoveEncoding .gz
+		Header set Content-Encoding gzip
+	</FilesMatch>
+	<FilesMatch "\.html\.gz$">
+		ForceType text/html
+	</FilesMatch>
+	<FilesMatch "\.css\.gz$">
+		ForceType text/css
+	</FilesMatch>
+	<FilesMatch "\.js\.gz$">
+		ForceType application/javascript
+	</FilesMatch>
+	<FilesMatch "\.svg\.gz$">
+		ForceType image/svg+xml
+	</FilesMatch>
+	<FilesMatch "\.txt\.gz$">
+		ForceType text/plain
+	</FilesMatch>
+	<FilesMatch "\.json\.gz$">
+		ForceType application/json
+	</FilesMatch>
+	<FilesMatch "\.xml\.gz$">
+		ForceType application/xml
+	</FilesMatch>
+</IfModule>
+"""
+
+
+def make_dirs(file_name):
+	"""
+	Create the directory which will contain the named file if it doesn't exist.
+	"""
+	dir_name = os.path.dirname(file_name)
+	if not os.path.isdir(dir_name):
+		os.makedirs(dir_name)
+
+
+class Exporter(object):
+	"""
+	Exports pages and files into an output directory, keeping track of what has
+	been exported in a manifest which is used to make later exports incremental.
+	"""
+	
+	def __init__(self, output_dir, full = False):
+		self.output_dir = output_dir
+		
+		# Re-export everything, even if unchanged
+		self.full = full
+		
+		# The manifest of the previous export
+		try:
+			with open(os.path.join(output_dir, MANIFEST_FILE), "r") as f:
+				self.old_manifest = json.load(f)
+		except IOError:
+			self.old_manifest = {"pages": {}, "files": {}}
+		
+		# The manifest of this export. "pages" maps output file names to the ETag
+		# of the page, "files" maps output file names to [size, mtime] of the
+		# source file.
+		self.manifest = {"pages": {}, "files": {}}
+		
+		self.rendered  = 0
+		self.copied    = 0
+		self.unchanged = 0
+	
+	
+	def output_path(self, name):
+		return os.path.join(self.output_dir, name.lstrip("/"))
+	
+	
+	def export_page(self, url, name, expected_status = "200 OK", env = None):
+		"""
+		Render the page at the given URL and store it in the output file name
+		(relative to the output directory), unless it has not changed since the
+		last export. env gives any extra WSGI environment for the request.
+		"""
+		headers = {}
+		old_etag = self.old_manifest["pages"].get(name)
+		if not self.full and old_etag is not None and os.path.isfile(self.output_path(name)):
+			headers["If-None-Match"] = '"%s"'%old_etag
+		
+		response = app.app.request(url, headers = headers, env = env or {})
+		
+		if response.status.startswith("304"):
+			self.manifest["pages"][name] = old_etag
+			self.unchanged += 1
+			return
+		
+		if response.status != expected_status:
+			raise Exception("Exporting %s failed: %s"%(url, response.status))
+		
+		file_name = self.output_path(name)
+		make_dirs(file_name)
+		with open(file_name, "wb") as f:
+			f.write(response.data)
+		with open(file_name + ".gz", "wb") as f:
+			f.write(compress.gzip_data(response.data, app.gzip_settings.level))
+		
+		self.manifest["pages"][name] = response.headers.get("ETag", "").strip('"')
+		self.rendered += 1
+	
+	
+	def export_file(self, source, name):
+		"""
+		Copy the file source to the output file name unless the previously exported
+		copy is from a source with the same size and mtime.
+		"""
+		st = os.stat(source)
+		signature = [st.st_size, int(st.st_mtime)]
+		self.manifest["files"][name] = signature
+		
+		file_name = self.output_path(name)
+		if (not self.full and self.old_manifest["files"].get(name) == signature
+		    and os.path.isfile(file_name)):
+			self.unchanged += 1
+			return
+		
+		make_dirs(file_name)
+		shutil.copy2(source, file_name)
+		self.copied += 1
+	
+	
+	def export_tree(self, source_dir, name):
+		"""
+		Copy all files in the source directory into the output directory name.
+		"""
+		for dir_path, dir_names, file_names in os.walk(source_dir):
+			for file_name in file_names:
+				source = os.path.join(dir_path, file_name)
+				rel    = os.path.relpath(source, source_dir)
+				self.export_file(source, os.path.join(name, rel))
+	
+	
+	def export_publications(self, handler):
+		"""
+		Export the listing, tag pages, publications and publication files of a
+		publication.Publications handler.
+		"""
+		url_base = handler.url_base
+		toc = handler().load_toc()
+		
+		self.export_page(url_base, "%s.html"%url_base)
+		for tag, tag_url in toc.tags:
+			self.export_page("%s/tag/%s"%(url_base, tag_url),
+			                 "%s/tag/%s.html"%(url_base, tag_url))
+		
+		for pub_url in toc.pubs:
+			self.export_page("%s/%s"%(url_base, pub_url),
+			                 "%s/%s.html"%(url_base, pub_url))
+			
+			pub_dir = os.path.join(handler.pub_base, pub_url)
+			if os.path.isdir(pub_dir):
+				self.export_tree(pub_dir, "%s/%s"%(url_base, pub_url))
+	
+	
+	def export_browseable_dir(self, handler):
+		"""
+		Export the files and directory listings of a static.StaticBrowseableDir.
+		"""
+		url_base = handler.url_base
+		for dir_path, dir_names, file_names in os.walk(handler.path_base):
+			# Only what the live listings show
+			dir_names[:] = [d for d in dir_names if static.listable(d, True)]
+			
+			rel = os.path.relpath(dir_path, handler.path_base)
+			url = "%s/"%url_base if rel == "." else "%s/%s/"%(url_base, rel)
+			self.export_page(url, "%sindex.html"%url,
+			                 env = {static.EXPORT_ENV: True})
+			
+			for file_name in file_names:
+				if static.listable(file_name, False):
+					self.export_file(os.path.join(dir_path, file_name),
+					                 os.path.join(url, file_name))
+	
+	
+	def export_static_dir(self, handler):
+		"""
+		Export the files of a static.StaticDir.
+		"""
+		self.export_tree(handler.path_base, handler.url_base)
+	
+	
+	def remove_stale(self):
+		"""
+		Remove pages and files which were exported previously but not this time.
+		"""
+		stale = []
+		for name in self.old_manifest["pages"]:
+			if name not in self.manifest["pages"]:
+				stale.extend([name, name + ".gz"])
+		for name in self.old_manifest["files"]:
+			if name not in self.manifest["files"]:
+				stale.append(name)
+		
+		for name in stale:
+			if os.path.isfile(self.output_path(name)):
+				os.remove(self.output_path(name))
+	
+	
+	def finish(self):
+		"""
+		Remove stale outputs and write the .htaccess and manifest.
+		"""
+		self.remove_stale()
+		
+		with open(self.output_path(".htaccess"), "w") as f:
+			f.write(HTACCESS)
+		
+		# Written last (and atomically) so that an interrupted export is redone
+		manifest_file = self.output_path(MANIFEST_FILE)
+		with open(manifest_file + ".tmp", "w") as f:
+			json.dump(self.manifest, f)
+		os.rename(manifest_file + ".tmp", manifest_file)
+
+
+def export_site(output_dir, full = False):
+	"""
+	Export every page and file served by the handlers listed in app.urls. If full
+	is True, everything is re-exported whether or not it has changed.
+	"""
+	exporter = Exporter(output_dir, full)
+	
+	exported = set()
+	for pattern, name in zip(app.urls[::2], app.urls[1::2]):
+		handler = getattr(app, name, None)
+		if handler is None or name in exported:
+			continue
+		exported.add(name)
+		
+		if hasattr(handler, "pub_base"):
+			exporter.export_publications(handler)
+		elif isinstance(handler, type) and issubclass(handler, static._StaticBase):
+			if hasattr(handler, "listing_template"):
+				exporter.export_browseable_dir(handler)
+			else:
+				exporter.export_static_dir(handler)
+		elif pattern == "/":
+			exporter.export_page(pattern, "index.html")
+		elif not any(c in pattern for c in "()[]*+?.\\|^$"):
+			# A page with a fixed URL (e.g. a StaticTemplate)
+			exporter.export_page(pattern, "%s.html"%pattern)
+		else:
+			sys.stderr.write("WARNING: Don't know how to export '%s' (%s)\n"%(
+				pattern, name))
+	
+	exporter.export_page(NOT_FOUND_URL, "404.html", "404 Not Found")
+	
+	exporter.finish()
+	return exporter
+
+
+if __name__=="__main__":
+	args = sys.argv[1:]
+	
+	full = False
+	if args and args[0] == "--full":
+		full = True
+		args = args[1:]
+	
+	if len(args) != 1:
+		sys.stderr.write(__doc__)
+		sys.exit(1)
+	
+	exporter = export_site(args[0], full)
+	print "%d pages rendered, %d files copied, %d unchanged"%(
+		exporter.rendered, exporter.copied, exporter.unchanged)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+"""
+Sending of rendered (HTML) pages, with caching of the rendered output,
+conditional GET support and on-the-fly compression.
+"""
+
+import web
+
+import re
+import hashlib
+
+import cache
+import compress
+import conditional
+
+# Number of rendered pages kept by handlers without an explicitly given cache
+DEFAULT_PAGE_CACHE_SIZE = 128
+
+# Matches the <%inherit file="..."/> tag of a Mako template
+INHERIT_RE = re.compile(r"""<%inherit\s+file\s*=\s*["']([^"']*)["']""")
+
+
+def read_inherited_uri(file_name):
+	"""
+	Return the URI of the template inherited by the named template file (or None
+	if it doesn't inherit one).
+	"""
+	with open(file_name, "r") as f:
+		match = INHERIT_RE.search(f.read())
+	return match.group(1) if match is not None else None
+
+# The URIs inherited by template files, re-read only when the files change
+inherited_uris = cache.FileCache(read_inherited_uri)
+
+
+def template_files(template):
+	"""
+	Return the file names of a Mako template and of every template it inherits
+	from (e.g. normal.mako and base.mako), all of which a page rendered from it
+	depends on.
+	"""
+	file_names = []
+	while template is not None and template.filename not in file_names:
+		file_names.append(template.filename)
+		try:
+			uri = inherited_uris.get(template.filename)
+		except IOError:
+			uri = None
+		if uri is not None and template.lookup is not None:
+			template = template.lookup.get_template(
+				template.lookup.adjust_uri(uri, template.uri))
+		else:
+			template = None
+	return file_names
+
+
+def kwargs_version(kwargs):
+	"""
+	Return a short hash of the template arguments given to a handler (e.g. the
+	site_menu) to be included in the keys of the pages it renders so that they
+	(and their ETags) change along with them.
+	"""
+	return hashlib.sha1(repr(sorted(kwargs.items()))).hexdigest()[:8]
+
+
+def serve_page(page_cache, key, input_files, render, cache_control,
+               gzip_settings = compress.DEFAULT_GZIP_SETTINGS, signatures = None):
+	"""
+	Send the page identified by key (a tuple) and return the response body.
+	
+	The page is produced by calling render() which returns its HTML. Renderings
+	are kept in page_cache (a cache.LRUCache) and reused for as long as all of
+	input_files (None entries are ignored) remain unchanged. The input_files
+	should include every template used (see template_files) and key anything
+	else the page is rendered from (see kwargs_version). Versions compressed
+	according to gzip_settings (a compress.GzipSettings) are cached along with
+	them. If the client already has the current version of the page, a 304 is
+	sent without rendering anything.
+	
+	If the caller has already found the stat signatures of input_files (with
+	cache.stat_signatures), they may be given to save stat-ing the files again.
+	"""
+	if signatures is None:
+		signatures = cache.stat_signatures(input_files)
+	gzip_ok    = compress.accepts_gzip()
+	
+	# Compressed and uncompressed versions of a page need different ETags
+	web.header("Vary", "Accept-Encoding")
+	last_modified, etag = conditional.validators(signatures, key, gzip_ok)
+	conditional.check(last_modified, etag, cache_control)
+	
+	body = page_cache.get(key + signatures)
+	if body is None:
+		body = compress.Body(web.safestr(render()), gzip_settings)
+		page_cache.put(key + signatures, body)
+	
+	conditional.set_headers(last_modified, etag, cache_control)
+	web.header("Content-Type", "text/html")
+	return compress.send(body, gzip_ok)
@@ -9,14 +9,89 @@ import web
 import os
 import re
 import json
-import mimetypes
+
+import cache
+import pages
+import stream
+import compress
+import conditional
+
+# Matches TeX math to be typeset by MathJax in the browser
+MATH_RE = re.compile(r"(?<!\\)(\$\$?).+?\1")
+
+
+def load_json(file_name):
+	"""
+	Load a JSON file and return the data within
+	"""
+	with open(file_name, "r") as json_file:
+		return json.load(json_file)
+
+
+def to_url(text):
+	"""
+	Convert a tag name into the form used in URLs.
+	"""
+	return text.lower().replace(" ", "+")
+
+
+class ToCIndex(object):
+	"""
+	A parsed toc.json along with lookup tables so that requests don't need to scan
+	the whole ToC.
+	
+	toc is the list of publications as loaded from the file.
+	
+	pubs maps publication URLs to their entry in the ToC.
+	
+	tags is a sorted list of (tag_name, tag_url) pairs for every tag used by a
+	visible publication.
+	
+	tag_names maps tag URLs to tag names.
+	
+	listings maps tag names to the list of visible publications with that tag in
+	listing order (reverse order of the file so that recently added items appear
+	first). The key None gives all visible publications.
+	"""
+	
+	def __init__(self, toc):
+		self.toc = toc
+		
+		self.pubs = {}
+		for pub in toc:
+			self.pubs.setdefault(pub["url"], pub)
+		
+		visible = [pub for pub in toc[::-1] if pub["show"]]
+		
+		tag_names = set()
+		for pub in visible:
+			tag_names.update(pub["tags"])
+		self.tags = [(tag, to_url(tag)) for tag in sorted(tag_names)]
+		
+		self.tag_names = {}
+		for tag, tag_url in self.tags:
+			self.tag_names.setdefault(tag_url, tag)
+		
+		self.listings = {None: visible}
+		for pub in visible:
+			for tag in set(pub["tags"]):
+				self.listings.setdefault(tag, []).append(pub)
+
+
+def load_toc_index(file_name):
+	"""
+	Load a ToC JSON file and return a ToCIndex of it.
+	"""
+	return ToCIndex(load_json(file_name))
+
 
 tags_re = re.compile("^/tag/([^/]*)$")
 pub_re  = re.compile("^/([^/]*)$")
 stat_re = re.compile("^/([^/]*)/(.*)$")
 
 def Publications(url_base_, pub_base_, title_,
-                 listing_template_, pub_template_, **kwargs_):
+                 listing_template_, pub_template_, page_cache_ = None,
+                 gzip_settings_ = compress.DEFAULT_GZIP_SETTINGS, **kwargs_):
 	"""
 	A publication serving handler.
 	
@@ -41,6 +116,8 @@ def Publications(url_base_, pub_base_, title_,
 				"abstract" : html snippet describing the article,
 				"tags"     : a list of tags describing the article,
 				"show"     : bool should the publication be listed?,
+				"mathjax"  : bool does the publication contain math which must be
+				             typeset by MathJax? (optional, assumed true if absent)
 			}
 		
 		/[pub_url].html for each publication which contains the content HTML for the
@@ -66,6 +143,9 @@ def Publications(url_base_, pub_base_, title_,
 		publications to be a list of (pub_title, pub_subtitle, pub_url, img_url,
 		img_alt, pub_abstract, pub_tags) tuples for each publication. Here pub_tags
 		is a list of (tag_name, tag_url) pairs.
+		
+		mathjax to be True if the readme or any abstract contains math to be
+		typeset by MathJax
 	
 	pub_template_ is a mako template for a publication. Specifies:
 		
@@ -74,8 +154,20 @@ def Publications(url_base_, pub_base_, title_,
 		content to be HTML page contents
 		
 		toc to be a list of (entry, url, ) for the table of contents
+		
+		mathjax to be True if the contents contain math to be typeset by MathJax
+	
+	page_cache_ is a cache.LRUCache in which rendered (and compressed) pages are
+	kept (and may be shared with other handlers). If not given, a private cache is
+	used. Cached pages are reused until any of the files they were rendered from
+	change.
+	
+	gzip_settings_ is the compress.GzipSettings with which pages are compressed.
 	"""
 	
+	if page_cache_ is None:
+		page_cache_ = cache.LRUCache(pages.DEFAULT_PAGE_CACHE_SIZE)
+	
 	class _Publications(object):
 		
 		url_base         = url_base_
@@ -85,25 +177,52 @@ def Publications(url_base_, pub_base_, title_,
 		pub_template     = pub_template_
 		kwargs           = kwargs_
 		
+		# Part of the key of every page (as they're rendered with kwargs)
+		kwargs_version   = pages.kwargs_version(kwargs_)
+		
+		# The indexed toc.json, only reloaded when the file changes on disk. This is
+		# shared by every request to this handler.
+		toc_cache = cache.FileCache(load_toc_index)
+		
+		page_cache    = page_cache_
+		gzip_settings = gzip_settings_
+		
+		# Cache-Control header sent with pages and files
+		cache_control = conditional.REVALIDATE
+		
 		
 		def load_json(self, file_name):
 			"""
-			Load the ToC JSON file and return the data within
+			Load a JSON file and return the data within
 			"""
-			with open(file_name, "r") as toc_file:
-				return json.load(toc_file)
+			return load_json(file_name)
 		
 		
-		def get_tags(self, toc):
-			tags = set()
-			for pub in toc:
-				if pub["show"]:
-					tags = tags.union(pub["tags"])
-			return sorted(tags)
+		def toc_file(self):
+			return os.path.join(self.pub_base, "toc.json")
+		
+		
+		def load_toc(self):
+			"""
+			Get the (cached) ToCIndex of the ToC JSON file.
+			"""
+			return self.toc_cache.get(self.toc_file())
+		
+		
+		def cached_page(self, key, input_files, render):
+			"""
+			Send the page identified by key, calling render() to produce it unless a
+			rendering exists which was made when all of input_files were the same as
+			they are now (see pages.serve_page).
+			"""
+			return pages.serve_page(self.page_cache,
+			                        (self.url_base, self.kwargs_version) + key,
+			                        input_files, render, self.cache_control,
+			                        self.gzip_settings)
 		
 		
 		def to_url(self, text):
-			return text.lower().replace(" ", "+")
+			return to_url(text)
 		
 		
 		def GET(self, url):
@@ -135,16 +254,23 @@ def Publications(url_base_, pub_base_, title_,
 		
 		
 		def GET_listing(self, tag_url = None):
-			toc = self.load_json(os.path.join(self.pub_base, "toc.json"))
-			tags = self.get_tags(toc)
-			tag_urls = map(self.to_url, tags)
+			return self.cached_page(
+				("listing", tag_url),
+				[ self.toc_file()
+				, os.path.join(self.pub_base, "README.html")
+				] + pages.template_files(self.listing_template),
+				lambda: self.render_listing(tag_url))
+		
+		
+		def render_listing(self, tag_url):
+			toc = self.load_toc()
 			
 			# Check that the tag exists
-			if tag_url is not None and tag_url not in tag_urls:
+			if tag_url is not None and tag_url not in toc.tag_names:
 				raise web.notfound()
 			
 			# Current tag name
-			tag = tags[tag_urls.index(tag_url)] if tag_url is not None else None
+			tag = toc.tag_names[tag_url] if tag_url is not None else None
 			
 			# Set the page title
 			if tag_url is None:
@@ -164,47 +290,51 @@ def Publications(url_base_, pub_base_, title_,
 			
 			# Generate the list of tags
 			tag_menu = [("Any", self.url_base, tag_url is None)]
-			for tag_, url_ in zip(tags, tag_urls):
+			for tag_, url_ in toc.tags:
 				tag_menu.append((tag_, tag_link(tag_),url_ == tag_url))
 			
-			# Generate list of publications (list in reverse order of the file so that
-			# recently added items appear first)
+			# Generate list of publications (already in listing order)
 			publications = []
-			for pub in toc[::-1]:
-				if pub["show"] and (tag is None or tag in pub["tags"]):
-					publications.append((
-						pub["title"],
-						pub["subtitle"],
-						"%s/%s"%(self.url_base, pub["url"]),
-						"%s/%s"%(self.url_base, pub["img"]) if pub["img"] is not None else None,
-						pub["img_alt"],
-						pub["abstract"],
-						[(t, tag_link(t)) for t in sorted(pub["tags"])],
-					))
-				else:
-					print "hidden", pub["show"], tag is None, tag in pub["tags"]
+			for pub in toc.listings[tag]:
+				publications.append((
+					pub["title"],
+					pub["subtitle"],
+					"%s/%s"%(self.url_base, pub["url"]),
+					"%s/%s"%(self.url_base, pub["img"]) if pub["img"] is not None else None,
+					pub["img_alt"],
+					pub["abstract"],
+					[(t, tag_link(t)) for t in sorted(pub["tags"])],
+				))
 			
 			# Render the page
-			web.header('Content-Type', 'text/html')
 			return self.listing_template.render(
 				title        = title,
 				heading      = self.title,
 				readme       = readme,
 				tags         = tag_menu,
 				publications = publications,
+				mathjax      = any(MATH_RE.search(text) is not None
+				                   for text in [readme] + [pub["abstract"]
+				                                           for pub in toc.listings[tag]]),
 				**self.kwargs
 			)
 		
 		
 		def GET_publication(self, publication_url):
+			return self.cached_page(
+				("publication", publication_url),
+				[ self.toc_file()
+				, os.path.join(self.pub_base, "%s.html"%publication_url)
+				, os.path.join(self.pub_base, "%s.toc"%publication_url)
+				] + pages.template_files(self.pub_template),
+				lambda: self.render_publication(publication_url))
+		
+		
+		def render_publication(self, publication_url):
 			# Get info from the publications toc
-			toc = self.load_json(os.path.join(self.pub_base, "toc.json"))
+			pub = self.load_toc().pubs.get(publication_url)
 			
 			# Check publication exists
-			for pub in toc:
-				if publication_url == pub["url"]:
-					break
-				pub = None
 			if pub is None:
 				raise web.notfound()
 			
@@ -218,25 +348,17 @@ def Publications(url_base_, pub_base_, title_,
 				pub_toc = None
 			
 			# Render the page
-			web.header('Content-Type', 'text/html')
 			return self.pub_template.render(
 				title   = "%s - %s"%(pub["title"], self.title),
 				content = pub_html,
 				toc     = pub_toc,
+				mathjax = pub.get("mathjax", True),
 				**self.kwargs
 			)
 		
 		
 		def GET_static_file(self, publication_name, path):
-			file_path = os.path.join(self.pub_base, publication_name, path)
-			try:
-				web.header("Content-Type", mimetypes.guess_type(file_path)[0])
-				with open(file_path, "rb") as f:
-					data = True
-					while data:
-						data = f.read(100)
-						yield data
-			except IOError:
-				raise web.notfound()
+			return stream.serve_file(os.path.join(self.pub_base, publication_name, path),
+			                         self.cache_control, precompressed = True)
 	
 	return _Publications
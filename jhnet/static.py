@@ -8,25 +8,225 @@ import web
 
 import os
 import stat
-import mimetypes
+import urllib
 import datetime
 
+# Use scandir where available (built into Python 3.5+ or the scandir package)
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+import cache
+import pages
+import stream
+import compress
+import conditional
+
+# Key in the WSGI environment set (to True) by jhnet/export.py when rendering
+# pages for a static export. (Unlike headers, clients can't set it.)
+EXPORT_ENV = "jhnet.export"
+
+
+def format_size(size):
+	"""
+	Format a file size in human-readable units.
+	"""
+	for fmt, div in ( ("%.2fGB", 1024*1024*1024)
+	                , ("%.1fMB", 1024*1024)
+	                , ("%dKB", 1024)
+	                ):
+		if size / div:
+			return fmt%(float(size) / div)
+	# Fall back on bytes
+	return "%dB"%size
+
+
+def read_file(file_name):
+	"""
+	Return the contents of a file.
+	"""
+	with open(file_name, "r") as f:
+		return f.read()
+
+
+def stat_dir(dir_path):
+	"""
+	Generate (file_name, is_dir, stat_result) tuples for the listable entries in a
+	directory (everything but dotfiles and the README.html). Hidden entries are
+	never stat-ed and, where scandir is available, no syscalls are needed to tell
+	directories apart.
+	"""
+	if scandir is not None:
+		for entry in scandir(dir_path):
+			if entry.name.startswith("."):
+				continue
+			is_dir = entry.is_dir()
+			if not listable(entry.name, is_dir):
+				continue
+			yield (entry.name, is_dir, entry.stat())
+	else:
+		for file_name in os.listdir(dir_path):
+			if file_name.startswith("."):
+				continue
+			st = os.stat(os.path.join(dir_path, file_name))
+			is_dir = stat.S_ISDIR(st.st_mode)
+			if not listable(file_name, is_dir):
+				continue
+			yield (file_name, is_dir, st)
+
+
+def listable(file_name, is_dir):
+	"""
+	Is the named directory entry shown in listings (i.e. not a dotfile or the
+	README.html)?
+	"""
+	return not (file_name.startswith(".") or (file_name == "README.html" and not is_dir))
+
+
+class DirListing(object):
+	"""
+	The listable contents of a directory (everything but dotfiles and the
+	README.html) with pre-formatted dates and sizes, sorted in each of the orders
+	offered by directory listings.
+	
+	orderings maps (sort_type, reverse) pairs to a list of (file_name, date, size)
+	tuples where sort_type is one of SORT_KEYS.
+	"""
+	
+	SORT_KEYS = {
+		"name" : (lambda (n,m_,s_,m,s) : n),
+		"date" : (lambda (n,m_,s_,m,s) : -m), # Reversed
+		"size" : (lambda (n,m_,s_,m,s) : s),
+	}
+	
+	def __init__(self, dir_path):
+		file_list = []
+		for file_name, is_dir, st in stat_dir(dir_path):
+			mtime = st.st_mtime
+			size  = st.st_size
+			
+			mtime_f = datetime.datetime.fromtimestamp(mtime).strftime("%d-%b-%Y %H:%M")
+			if is_dir:
+				size_f = "Directory"
+				file_name += "/"
+			else:
+				size = size or 0
+				size_f  = format_size(size)
+			
+			file_list.append((file_name, mtime_f, size_f, mtime, size))
+		
+		self.orderings = {}
+		for sort_type, sort_key in DirListing.SORT_KEYS.iteritems():
+			for sort_reverse in (False, True):
+				self.orderings[(sort_type, sort_reverse)] = [
+					(n, m, s)
+					for (n,m,s,m_,s_) in
+					sorted(file_list, key=sort_key, reverse = sort_reverse)]
+
 
 class _StaticBase(object):
 	
+	# Number of bytes read at a time when streaming files through Python
+	chunk_size = stream.CHUNK_SIZE
+	
+	# Cache-Control header sent with files and listings
+	cache_control = conditional.REVALIDATE
+	
+	# Send precompressed (.gz/.br) versions of files where available
+	precompressed = True
+	
+	# How rendered listings are compressed
+	gzip_settings = compress.DEFAULT_GZIP_SETTINGS
+	
+	# Number of entries per page of a directory listing by default and the most
+	# which may be requested (using ?limit=)
+	page_size     = 500
+	max_page_size = 5000
+	
 	def file_path(self, suffix):
 		return "%s%s"%(self.path_base, suffix)
 	
 	
 	def format_size(self, size):
-		for fmt, div in ( ("%.2fGB", 1024*1024*1024)
-		                , ("%.1fMB", 1024*1024)
-		                , ("%dKB", 1024)
-		                ):
-			if size / div:
-				return fmt%(float(size) / div)
-		# Fall back on bytes
-		return "%dB"%size
+		return format_size(size)
+	
+	
+	def listing_query(self, num_entries):
+		"""
+		Normalise the query parameters of a request for a directory listing with
+		num_entries entries. Returns (sort_type, sort_reverse, limit, page_num)
+		where limit is None if the default page size was not overridden and page_num
+		is the page (from 1) to show.
+		"""
+		params = web.input()
+		
+		sort_type = params.get("sort",None)
+		if sort_type not in DirListing.SORT_KEYS:
+			sort_type = "date"
+		
+		sort_reverse = "reverse" in params
+		
+		try:
+			limit = min(max(int(params["limit"]), 1), self.max_page_size)
+		except (KeyError, ValueError):
+			limit = None
+		
+		page_size = limit or self.page_size
+		num_pages = max((num_entries + page_size - 1) // page_size, 1)
+		
+		try:
+			page_num = min(max(int(params["page"]), 1), num_pages)
+		except (KeyError, ValueError):
+			page_num = 1
+		
+		return (sort_type, sort_reverse, limit, page_num)
+	
+	
+	def paginate(self, file_list, sort_type, sort_reverse, limit, page_num):
+		"""
+		Select the page of file_list given by a normalised query (see
+		listing_query). Returns the entries on the page and a list of (label, url,
+		css_class) tuples for the pagination links (empty if everything fits on one
+		page).
+		"""
+		page_size = limit or self.page_size
+		num_pages = max((len(file_list) + page_size - 1) // page_size, 1)
+		
+		entries = file_list[(page_num - 1) * page_size : page_num * page_size]
+		
+		if num_pages == 1:
+			return entries, []
+		
+		# Links keep the rest of the query
+		query = []
+		if limit is not None:
+			query.append(("limit", limit))
+		if sort_reverse:
+			query.append(("reverse", ""))
+		query.append(("sort", sort_type))
+		def page_url(num):
+			return "?%s"%urllib.urlencode(query + [("page", num)])
+		
+		# Links to the first, last and nearby pages along with prev/next
+		shown = sorted(set([1, num_pages]) |
+		               set(range(max(page_num - 3, 1), min(page_num + 3, num_pages) + 1)))
+		pagination = [("&laquo;", page_url(max(page_num - 1, 1)),
+		               "disabled" if page_num == 1 else "")]
+		last_shown = 0
+		for num in shown:
+			if num != last_shown + 1:
+				pagination.append(("&hellip;", "#", "disabled"))
+			pagination.append((str(num), page_url(num),
+			                   "active" if num == page_num else ""))
+			last_shown = num
+		pagination.append(("&raquo;", page_url(min(page_num + 1, num_pages)),
+		                   "disabled" if page_num == num_pages else ""))
+		
+		return entries, pagination
 	
 	
 	def GET(self, path):
@@ -47,40 +247,50 @@ class _StaticBase(object):
 	
 	
 	def GET_dir_listing(self, path):
-		# File list generation
-		file_list = []
-		for file_name in os.listdir(self.file_path(path)):
-			file_path = os.path.join(self.file_path(path), file_name)
-			(mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(file_path)
-			
-			mtime_f = datetime.datetime.fromtimestamp(mtime).strftime("%d-%b-%Y %H:%M")
-			if stat.S_ISDIR(mode):
-				size_f = "Directory"
-				file_name += "/"
-			else:
-				size = size or 0
-				size_f  = self.format_size(size)
-			
-			# Filter out the README/dotfiles
-			if file_name != "README.html" and not file_name.startswith("."):
-				file_list.append((file_name, mtime_f, size_f, mtime, size))
+		dir_path = self.file_path(path)
 		
-		params = web.input()
-		sort_keys = {
-			"name" : (lambda (n,m_,s_,m,s) : n),
-			"date" : (lambda (n,m_,s_,m,s) : -m), # Reversed
-			"size" : (lambda (n,m_,s_,m,s) : s),
-		}
-		sort_type = params.get("sort",None)
-		if sort_type not in sort_keys:
-			sort_type = "date"
-		sort_key = sort_keys[sort_type]
+		# The listing depends only on the directory, README, templates and query.
+		# (The files are stat-ed once for both the listing and page caches.)
+		input_files = [ dir_path
+		              , os.path.join(dir_path, "README.html")
+		              ] + pages.template_files(self.listing_template)
+		signatures = cache.stat_signatures(input_files)
 		
-		sort_reverse = "reverse" in params
+		# The directory's contents (re-read only when the directory changes)
+		listing = self.listing_cache.get(dir_path, signatures[0])
+		
+		num_entries = len(listing.orderings[("name", False)])
+		
+		# Exported listings can't use query strings so list every entry, in the
+		# default order, on one page
+		sortable = not web.ctx.env.get(EXPORT_ENV, False)
+		if sortable:
+			# Only the normalised query is part of the key so that junk query strings
+			# can't fill the page cache
+			query = self.listing_query(num_entries)
+		else:
+			query = ("date", False, max(num_entries, 1), 1)
+		
+		return pages.serve_page(
+			self.page_cache,
+			(self.url_base, self.kwargs_version, "listing", path, sortable) + query,
+			input_files,
+			lambda: self.render_dir_listing(path, listing, sortable, *query),
+			self.cache_control,
+			self.gzip_settings,
+			signatures)
+	
+	
+	def render_dir_listing(self, path, listing, sortable, sort_type, sort_reverse,
+	                       limit, page_num):
+		dir_path = self.file_path(path)
+		
+		file_list, pagination = self.paginate(listing.orderings[(sort_type, sort_reverse)],
+		                                      sort_type, sort_reverse, limit, page_num)
 		
 		# Try and find a readme to display
 		try:
-			readme = open(os.path.join(self.file_path(path), "README.html"), "r").read()
+			readme = self.readme_cache.get(os.path.join(dir_path, "README.html"))
 		except IOError:
 			readme = ""
 		
@@ -92,14 +302,14 @@ class _StaticBase(object):
 			cur_path += sub_path
 			breadcrumb.append((cur_path, sub_path))
 		
-		web.header('Content-Type', 'text/html')
 		return self.listing_template.render(
 			title          = "Index of %s%s"%(self.url_base, path),
 			readme         = readme,
 			breadcrumb     = breadcrumb,
-			file_list      = [(n, m, s)
-			                  for (n,m,s,m_,s_) in
-			                  sorted(file_list, key=sort_key, reverse = sort_reverse)],
+			file_list      = file_list,
+			pagination     = pagination,
+			sortable       = sortable,
+			limit_query    = "&limit=%d"%limit if limit is not None else "",
 			toggle_reverse = "reverse" if not sort_reverse else "",
 			name_class     = ["sort-asc","sort-dsc"][sort_reverse]
 			                 if sort_type == "name" else "",
@@ -112,44 +322,53 @@ class _StaticBase(object):
 	
 	
 	def GET_static_file(self, path):
-		try:
-			file_path = "%s%s"%(self.path_base, path)
-			web.header("Content-Type", mimetypes.guess_type(file_path)[0])
-			with open(file_path, "rb") as f:
-				data = True
-				while data:
-					data = f.read(100)
-					yield data
-		except IOError:
-			raise web.notfound()
+		return stream.serve_file("%s%s"%(self.path_base, path),
+		                         self.cache_control, self.chunk_size,
+		                         self.precompressed)
 
 
 
-def StaticBrowseableDir(url_base_, path_base_, listing_template_, **kwargs_):
+def StaticBrowseableDir(url_base_, path_base_, listing_template_,
+                        page_cache_ = None,
+                        gzip_settings_ = compress.DEFAULT_GZIP_SETTINGS, **kwargs_):
 	"""
 	Produces a web.py handler which allows access to static files in the specified
-	directory with directory listings.
+	directory with directory listings. Rendered listings are kept in page_cache_
+	(a cache.LRUCache, by default a private one) and compressed according to
+	gzip_settings_ (a compress.GzipSettings).
 	"""
 	
+	if page_cache_ is None:
+		page_cache_ = cache.LRUCache(pages.DEFAULT_PAGE_CACHE_SIZE)
+	
 	class _Static(_StaticBase):
 		url_base         = url_base_
 		path_base        = path_base_
 		listing_template = listing_template_
 		kwargs           = kwargs_
+		kwargs_version   = pages.kwargs_version(kwargs_)
+		page_cache       = page_cache_
+		gzip_settings    = gzip_settings_
+		
+		# Directory contents and READMEs, reloaded when they change on disk
+		listing_cache = cache.FileCache(DirListing)
+		readme_cache  = cache.FileCache(read_file)
 	
 	return _Static
 
 
 
-def StaticDir(url_base_, path_base_):
+def StaticDir(url_base_, path_base_, cache_control_ = conditional.REVALIDATE):
 	"""
 	Produces a web.py handler which allows access to static files in the specified
-	directory but without directory listings.
+	directory but without directory listings. The files are sent with the given
+	Cache-Control header.
 	"""
 	
 	class _Static(_StaticBase):
-		url_base  = url_base_
-		path_base = path_base_
+		url_base      = url_base_
+		path_base     = path_base_
+		cache_control = cache_control_
 		def GET_dir_listing(self, path):
 			raise web.forbidden()
 	
@@ -167,14 +386,26 @@ def StaticFile(file_path):
 	return _StaticFile
 
 
-def StaticTemplate(template, **kwargs):
+def StaticTemplate(template, page_cache = None,
+                   gzip_settings = compress.DEFAULT_GZIP_SETTINGS, **kwargs):
 	"""
 	Returns a web.py handler which always responds with the specified template
-	(taking no arguments).
+	(taking no arguments). The rendered page is kept in page_cache (a
+	cache.LRUCache, by default a private one) and compressed according to
+	gzip_settings (a compress.GzipSettings).
 	"""
+	if page_cache is None:
+		page_cache = cache.LRUCache(1)
+	
+	kwargs_version = pages.kwargs_version(kwargs)
+	
 	class _StaticTemplate(object):
 		def GET(self):
-			web.header('Content-Type', 'text/html')
-			return template.render(**kwargs)
+			return pages.serve_page(page_cache,
+			                        ("template", template.uri, kwargs_version),
+			                        pages.template_files(template),
+			                        lambda: template.render(**kwargs),
+			                        conditional.REVALIDATE,
+			                        gzip_settings)
 	
 	return _StaticTemplate
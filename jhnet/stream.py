@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+"""
+Streaming of files as response bodies.
+
+Files are either read in large chunks by a generator or, when the WSGI server
+provides wsgi.file_wrapper and the app is wrapped in FileWrapperMiddleware,
+handed to the server in their entirety (allowing it to use sendfile or similar).
+
+Byte range requests (including multiple ranges) are supported for files.
+"""
+
+import web
+
+import os
+import uuid
+import mimetypes
+
+import cache
+import compress
+import conditional
+
+# Number of bytes read from a file at a time when streaming it through Python
+CHUNK_SIZE = 256*1024
+
+# Key in the WSGI environment used to pass files from stream_file to
+# FileWrapperMiddleware. Present only when the middleware is in use.
+FILE_WRAPPER_KEY = "jhnet.file_wrapper"
+
+
+def copy_chunks(f, chunk_size, length = None):
+	"""
+	A generator which yields the contents of the file-like object f from its
+	current position in chunks of (at most) chunk_size bytes, stopping after
+	length bytes if given.
+	"""
+	while length is None or length > 0:
+		data = f.read(chunk_size if length is None else min(chunk_size, length))
+		if not data:
+			break
+		if length is not None:
+			length -= len(data)
+		yield data
+
+
+def read_chunks(f, chunk_size = CHUNK_SIZE, length = None):
+	"""
+	A generator which yields the contents of the file-like object f in chunks of
+	(at most) chunk_size bytes, stopping after length bytes if given. The file is
+	closed once exhausted.
+	"""
+	try:
+		for data in copy_chunks(f, chunk_size, length):
+			yield data
+	finally:
+		f.close()
+
+
+def read_parts(f, parts, tail, chunk_size = CHUNK_SIZE):
+	"""
+	A generator which yields the body of a multipart/byteranges response. parts
+	is a list of (head, start, length) triples giving the byte ranges of the
+	file-like object f to send, each preceded by the string head. The string tail
+	is sent last. The file is closed once exhausted.
+	"""
+	try:
+		for head, start, length in parts:
+			yield head
+			f.seek(start)
+			for data in copy_chunks(f, chunk_size, length):
+				yield data
+		yield tail
+	finally:
+		f.close()
+
+
+def parse_range(range_header, size):
+	"""
+	Parse the value of a Range header for a file of size bytes into a list of
+	(start, length) pairs. Returns None if no header was given or it is malformed
+	(and so should be ignored) and an empty list if none of the requested ranges
+	are satisfiable.
+	"""
+	if range_header is None:
+		return None
+	
+	unit, _, range_set = range_header.partition("=")
+	if unit.strip().lower() != "bytes":
+		return None
+	
+	specs = [spec.strip() for spec in range_set.split(",") if spec.strip()]
+	if not specs:
+		return None
+	
+	ranges = []
+	for spec in specs:
+		first, dash, last = spec.partition("-")
+		if not dash:
+			return None
+		try:
+			if first == "":
+				# Suffix range (the last N bytes)
+				start = max(size - int(last), 0)
+				end   = size
+			else:
+				start = int(first)
+				end   = min(int(last) + 1, size) if last else size
+				if last and int(last) < start:
+					return None
+		except ValueError:
+			return None
+		
+		# Drop unsatisfiable ranges
+		if start < end:
+			ranges.append((start, end - start))
+	
+	return ranges
+
+
+def stream_file(f, chunk_size = CHUNK_SIZE, start = 0, length = None):
+	"""
+	Set the Content-Length header and return a response body which sends the
+	contents of the open file f, optionally just the length bytes from start.
+	"""
+	size = os.fstat(f.fileno()).st_size
+	if length is None:
+		length = size - start
+	
+	web.header("Content-Length", str(length))
+	f.seek(start)
+	
+	environ = web.ctx.environ
+	if (FILE_WRAPPER_KEY in environ and "wsgi.file_wrapper" in environ
+	    and start + length == size):
+		# Leave the file for FileWrapperMiddleware to give to the server
+		environ[FILE_WRAPPER_KEY] = (f, chunk_size)
+		return ""
+	else:
+		return read_chunks(f, chunk_size, length)
+
+
+def stream_ranges(f, ranges, content_type, chunk_size = CHUNK_SIZE):
+	"""
+	Set the Content-Type and Content-Length headers and return a
+	multipart/byteranges response body containing the given (start, length)
+	ranges of the open file f.
+	"""
+	size     = os.fstat(f.fileno()).st_size
+	boundary = uuid.uuid4().hex
+	
+	parts = []
+	for start, length in ranges:
+		head = "\r\n--%s\r\n"%boundary
+		if content_type is not None:
+			head += "Content-Type: %s\r\n"%content_type
+		head += "Content-Range: bytes %d-%d/%d\r\n\r\n"%(start, start + length - 1, size)
+		parts.append((head, start, length))
+	tail = "\r\n--%s--\r\n"%boundary
+	
+	web.header("Content-Type", "multipart/byteranges; boundary=%s"%boundary)
+	web.header("Content-Length",
+	           str(sum(len(head) + length for head, start, length in parts) + len(tail)))
+	return read_parts(f, parts, tail, chunk_size)
+
+
+def serve_file(file_path, cache_control, chunk_size = CHUNK_SIZE,
+               precompressed = False):
+	"""
+	Send the named file as the response (or a 304 if the client's copy is
+	current), returning the response body. Honours Range (and If-Range) headers.
+	If precompressed is True, a precompressed sidecar version of the file is sent
+	instead where one exists and the client accepts it. Raises web.notfound if the
+	file doesn't exist.
+	"""
+	signature = cache.stat_signature(file_path)
+	if signature is None:
+		raise web.notfound()
+	
+	send_path, encoding = file_path, None
+	if precompressed:
+		web.header("Vary", "Accept-Encoding")
+		send_path, signature, encoding = compress.find_sidecar(file_path, signature)
+	
+	last_modified, etag = conditional.validators([signature], encoding)
+	conditional.check(last_modified, etag, cache_control)
+	
+	try:
+		f = open(send_path, "rb")
+	except IOError:
+		raise web.notfound()
+	
+	content_type = mimetypes.guess_type(file_path)[0]
+	size         = os.fstat(f.fileno()).st_size
+	
+	# Only send part of the file if the client's partial copy is current
+	ranges = None
+	if conditional.range_applies(last_modified, etag):
+		ranges = parse_range(web.ctx.env.get("HTTP_RANGE"), size)
+	
+	conditional.set_headers(last_modified, etag, cache_control)
+	web.header("Accept-Ranges", "bytes")
+	if encoding is not None:
+		web.header("Content-Encoding", encoding)
+	
+	if ranges is None:
+		# The whole file
+		web.header("Content-Type", content_type)
+		return stream_file(f, chunk_size)
+	elif not ranges:
+		f.close()
+		raise web.HTTPError("416 Requested Range Not Satisfiable",
+		                    {"Content-Range": "bytes */%d"%size})
+	elif len(ranges) == 1:
+		start, length = ranges[0]
+		web.ctx.status = "206 Partial Content"
+		web.header("Content-Type", content_type)
+		web.header("Content-Range", "bytes %d-%d/%d"%(start, start + length - 1, size))
+		return stream_file(f, chunk_size, start, length)
+	else:
+		web.ctx.status = "206 Partial Content"
+		return stream_ranges(f, ranges, content_type, chunk_size)
+
+
+def FileWrapperMiddleware(app):
+	"""
+	WSGI middleware which passes files sent using stream_file to the server's
+	wsgi.file_wrapper rather than streaming them through Python.
+	"""
+	def wrapped(environ, start_response):
+		environ[FILE_WRAPPER_KEY] = None
+		result = app(environ, start_response)
+		
+		handoff = environ.get(FILE_WRAPPER_KEY)
+		if handoff is None:
+			return result
+		
+		# Run the (empty) body produced by the app to completion so that it can
+		# clean up after the request.
+		for _ in result:
+			pass
+		if hasattr(result, "close"):
+			result.close()
+		
+		f, chunk_size = handoff
+		return environ["wsgi.file_wrapper"](f, chunk_size)
+	
+	return wrapped
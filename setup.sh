@@ -33,13 +33,7 @@ virtualenv --distribute .
 echo 'sys.path.append("'"$REPO_DIR"'")'                >> lib/python*/site.py
 echo 'os.environ["JHNET_DIR"]="'$(readlink -f "`pwd`")'"' >> lib/python*/site.py
 
-# Activate the virtualenv
-source bin/activate
-
-pip install web.py
-pip install mako
-pip install flup
-
-deactivate
+# Install the requirements and generate static files (as after every update)
+"$REPO_DIR/update.sh" || exit 1
 
 echo "Done!"
@@ -15,15 +15,21 @@ ${readme}
 		
 		<thead>
 			<tr>
-				<th>
-					<a href="?sort=name&${toggle_reverse}">Name <span class="${name_class}"></span></a>
-				</th>
-				<th class="span3">
-					<a href="?sort=date&${toggle_reverse}">Date Uploaded <span class="${date_class}"></span></a>
-				</th>
-				<th class="span2">
-					<a href="?sort=size&${toggle_reverse}">Size <span class="${size_class}"></span></a>
-				</th>
+				% if sortable:
+					<th>
+						<a href="?sort=name&${toggle_reverse}${limit_query}">Name <span class="${name_class}"></span></a>
+					</th>
+					<th class="span3">
+						<a href="?sort=date&${toggle_reverse}${limit_query}">Date Uploaded <span class="${date_class}"></span></a>
+					</th>
+					<th class="span2">
+						<a href="?sort=size&${toggle_reverse}${limit_query}">Size <span class="${size_class}"></span></a>
+					</th>
+				% else:
+					<th>Name</th>
+					<th class="span3">Date Uploaded</th>
+					<th class="span2">Size</th>
+				% endif
 			</tr>
 		</thead>
 		
@@ -38,4 +44,14 @@ ${readme}
 		</tbody>
 		
 	</table>
+	
+	% if pagination:
+		<div class="pagination pagination-centered">
+			<ul>
+				% for label, link, css_class in pagination:
+					<li class="${css_class}"><a href="${link | h}">${label}</a></li>
+				% endfor
+			</ul>
+		</div>
+	% endif
 </div>
@@ -2,14 +2,16 @@
 
 <%block name="includes">
 	<link href="${root_path}css/pygments.css" rel="stylesheet">
-	<script type="text/javascript"
-		src="http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML">
-	</script>
-	<script type="text/javascript">
-		MathJax.Hub.Config({
-			"tex2jax": { inlineMath: [ [ '$', '$' ] ] }
-		});
-	</script>
+	% if mathjax:
+		<script type="text/javascript"
+			src="http://cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML">
+		</script>
+		<script type="text/javascript">
+			MathJax.Hub.Config({
+				"tex2jax": { inlineMath: [ [ '$', '$' ] ] }
+			});
+		</script>
+	% endif
 </%block>
 
 
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+# Brings a Jhnet site root (the current working directory, as set up by
+# setup.sh) up to date with this repository: installs any new requirements and
+# regenerates the generated static files. Run after every update of the
+# repository (e.g. git pull).
+
+REPO_DIR="$(readlink -f "$(dirname "$0")")"
+
+# Activate the virtualenv
+source bin/activate \
+	|| { echo "No virtualenv here: run from a site root set up by setup.sh." >&2; exit 1; }
+
+pip install web.py
+pip install mako
+pip install flup
+pip install scandir
+pip install pygments
+
+# Stylesheet for highlighted code in publications (which are left unstyled
+# without it)
+python "$REPO_DIR/util/pygments_css.py" "$REPO_DIR/static/css/pygments.css" \
+	|| { echo "Failed to generate static/css/pygments.css!" >&2; exit 1; }
+
+deactivate
+
+# Precompressed versions of static resources
+python "$REPO_DIR/util/precompress.py" "$REPO_DIR/static" > /dev/null
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Compiles every publication in a directory of markdown files in parallel.
+
+Usage:
+
+	batch_compile.py [-j jobs] [--force] [--svg] [--prerender-math]
+	                 [--image-formats=webp,avif] [--asset-store=dir]
+	                 source_dir output_dir
+	
+	Every *.md file under source_dir is compiled (as by compile.py) into
+	output_dir using a pool of jobs worker processes (default: one per CPU). The
+	publication URL of each file is its basename without the extension and with
+	spaces replaced by "-" (as in "jhnet pub"). Each worker reuses one Markdown
+	instance for all the articles it compiles (see compile.MarkdownCompiler)
+	and renders their images with a single thread.
+	
+	Once all articles are compiled, their meta-data is merged into
+	output_dir/toc.json in a single atomic write. Articles already in the ToC
+	keep their position, new articles are appended in file name order.
+	Articles which fail to compile are reported and left out of the ToC update.
+	
+	Articles whose inputs are unchanged since they were last compiled are
+	skipped (see manifest.py) unless --force is given. --svg, --prerender-math,
+	--image-formats and --asset-store are as for compile.py. With --asset-store,
+	assets shared between articles are stored once.
+	
+	The time taken to compile each article is reported, slowest first.
+"""
+
+import os
+import sys
+import json
+import time
+import traceback
+import multiprocessing
+
+from compile import compile_file, parse_image_formats
+
+
+def find_sources(source_dir):
+	"""
+	Returns a sorted list of (input_file_name, url) for all markdown files under
+	source_dir.
+	"""
+	sources = []
+	for dir_path, dir_names, file_names in os.walk(source_dir):
+		for file_name in file_names:
+			if file_name.endswith(".md"):
+				url = file_name.split(".")[0].replace(" ", "-")
+				sources.append((os.path.join(dir_path, file_name), url))
+	sources.sort()
+	
+	# URLs must be unique as all articles are placed in the same directory
+	seen = {}
+	for input_file_name, url in sources:
+		if url in seen:
+			raise Exception("%s and %s would both be compiled to '%s'"%(
+				seen[url], input_file_name, url))
+		seen[url] = input_file_name
+	
+	return sources
+
+
+def compile_one(args):
+	"""
+	Worker: compile one article. Returns (input_file_name, meta, seconds, error)
+	where error is None on success (and meta None on failure).
+	"""
+	input_file_name, output_path, url, force, options = args
+	start = time.time()
+	try:
+		# The articles are already compiled by one process per CPU so each renders
+		# its images with a single thread
+		meta  = compile_file(input_file_name, output_path, url, force, threads = 1,
+		                     **options)
+		error = None
+	except Exception:
+		meta  = None
+		error = traceback.format_exc()
+	return (input_file_name, meta, time.time() - start, error)
+
+
+def merge_metas(toc_json, metas):
+	"""
+	Merge a list of article meta-data into the ToC (a list of meta-data) in
+	place. Existing entries with the same URL are replaced where they stand,
+	other articles are appended in the order given.
+	"""
+	index = dict((pub["url"], num) for num, pub in enumerate(toc_json))
+	for meta in metas:
+		if meta["url"] in index:
+			toc_json[index[meta["url"]]] = meta
+		else:
+			index[meta["url"]] = len(toc_json)
+			toc_json.append(meta)
+
+
+def write_toc(toc_json_file_name, toc_json):
+	"""
+	Atomically replace the ToC file.
+	"""
+	with open(toc_json_file_name + ".tmp", "w") as f:
+		json.dump(toc_json, f)
+	os.rename(toc_json_file_name + ".tmp", toc_json_file_name)
+
+
+def batch_compile(source_dir, output_path, jobs = None, force = False, **options):
+	"""
+	Compile all articles in source_dir into output_path and update its toc.json.
+	If force is True, articles are compiled even if their inputs are unchanged.
+	Any options are passed on to compile_file.
+	Returns a list of (input_file_name, meta, seconds, error) for every article.
+	"""
+	sources = find_sources(source_dir)
+	
+	if not os.path.isdir(output_path):
+		os.makedirs(output_path)
+	
+	pool = multiprocessing.Pool(jobs)
+	try:
+		results = pool.map(compile_one,
+		                   [(input_file_name, output_path, url, force, options)
+		                    for input_file_name, url in sources],
+		                   chunksize = 1)
+	finally:
+		pool.close()
+		pool.join()
+	
+	toc_json_file_name = os.path.join(output_path, "toc.json")
+	if os.path.isfile(toc_json_file_name):
+		with open(toc_json_file_name, "r") as f:
+			toc_json = json.load(f)
+	else:
+		toc_json = []
+	
+	merge_metas(toc_json, [meta for _, meta, _, error in results if error is None])
+	write_toc(toc_json_file_name, toc_json)
+	
+	return results
+
+
+if __name__=="__main__":
+	args = sys.argv[1:]
+	
+	jobs = None
+	if len(args) > 2 and args[0] == "-j":
+		jobs = int(args[1])
+		args = args[2:]
+	
+	force = False
+	options = {}
+	while args and args[0].startswith("--"):
+		flag = args.pop(0)
+		if flag == "--force":
+			force = True
+		elif flag == "--svg":
+			options["latex_img_format"] = "svg"
+		elif flag == "--prerender-math":
+			options["mathjax_prerender"] = True
+		elif flag.startswith("--image-formats="):
+			options["image_formats"] = parse_image_formats(flag.partition("=")[2])
+		elif flag.startswith("--asset-store="):
+			options["asset_store"] = flag.partition("=")[2]
+		else:
+			sys.stderr.write(__doc__)
+			sys.exit(1)
+	
+	if len(args) != 2:
+		sys.stderr.write(__doc__)
+		sys.exit(1)
+	
+	start = time.time()
+	results = batch_compile(args[0], args[1], jobs, force, **options)
+	
+	# Report timings, slowest first
+	failed = 0
+	for input_file_name, meta, seconds, error in sorted(results,
+	                                                   key = (lambda r: r[2]),
+	                                                   reverse = True):
+		print "%8.2fs  %s%s"%(seconds, input_file_name,
+		                      "  FAILED" if error is not None else "")
+	
+	for input_file_name, meta, seconds, error in results:
+		if error is not None:
+			failed += 1
+			sys.stderr.write("ERROR: Compiling %s failed:\n%s\n"%(input_file_name, error))
+	
+	print "Compiled %d articles (%d failed) in %.2fs"%(
+		len(results) - failed, failed, time.time() - start)
+	
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the throughput of streaming static files through Python in small
+(the old 100 byte reads) and large (jhnet.stream.CHUNK_SIZE) chunks, and via a
+wsgi.file_wrapper implementation (wsgiref's, which does not use sendfile and so
+is a lower bound).
+
+Usage:
+
+	bench_stream.py [size_mb ...]
+	
+	Where each size_mb is the size of a test file to stream (default 1 and 100).
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from wsgiref.util import FileWrapper
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from jhnet.stream import read_chunks, CHUNK_SIZE
+
+
+def consume(body):
+	"""
+	Iterate over a response body as a WSGI server would, returning the number of
+	bytes it contained.
+	"""
+	total = 0
+	for data in body:
+		total += len(data)
+	return total
+
+
+def bench(file_name, make_body, min_time = 1.0):
+	"""
+	Repeatedly stream the given file using the body returned by make_body(f) for
+	at least min_time seconds and return the throughput in MB/s.
+	"""
+	total = 0
+	start = time.time()
+	while True:
+		total += consume(make_body(open(file_name, "rb")))
+		duration = time.time() - start
+		if duration >= min_time:
+			return total / duration / (1024*1024)
+
+
+if __name__=="__main__":
+	sizes = map(int, sys.argv[1:]) or [1, 100]
+	
+	methods = [
+		("100 byte chunks",          lambda f: read_chunks(f, 100)),
+		("%d byte chunks"%CHUNK_SIZE, lambda f: read_chunks(f, CHUNK_SIZE)),
+		("wsgi.file_wrapper",        lambda f: FileWrapper(f, CHUNK_SIZE)),
+	]
+	
+	for size in sizes:
+		fd, file_name = tempfile.mkstemp(prefix = "bench_stream_")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				block = os.urandom(1024*1024)
+				for _ in range(size):
+					f.write(block)
+			
+			for name, make_body in methods:
+				print "%4d MB, %-22s %8.1f MB/s"%(size, name + ":",
+				                                  bench(file_name, make_body))
+		finally:
+			os.remove(file_name)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the Markdown extractor extensions' tree processing on a synthetic
+document with many headings and links (default: 10k headings, 50k links).
+
+Times the old approach of one recursive walk per extractor against the single
+shared iterative walk of mdx_treewalk, both just collecting elements, and then
+the complete extractors (including ID and file name allocation) running on the
+shared walk.
+
+Usage:
+
+	bench_treewalk.py [num_headings [num_links]]
+"""
+
+import os
+import sys
+import time
+
+import xml.etree.ElementTree as etree
+
+sys.path.insert(0, os.path.dirname(__file__))
+from markdown.util import HTML_PLACEHOLDER_RE
+
+from mdx_treewalk          import TreeVisitor, TreeWalkerTreeprocessor
+from mdx_resourceextractor import ResourceExtractorVisitor
+from mdx_tocextractor      import ToCExtractorVisitor
+from mdx_abstractextractor import AbstractExtractorVisitor
+
+
+def make_document(num_headings, num_links):
+	"""
+	Build an ElementTree like that of a long article: sections each with a
+	heading and a paragraph of links, every other paragraph nested in a list. One
+	link in ten is to a local file.
+	"""
+	root = etree.Element("div")
+	link = 0
+	for section in range(num_headings):
+		heading = etree.SubElement(root, "h%d"%(1 + section%3))
+		heading.text = u"Section %d"%section
+		
+		if section%2:
+			parent = etree.SubElement(etree.SubElement(root, "ul"), "li")
+		else:
+			parent = root
+		p = etree.SubElement(parent, "p")
+		p.text = "Some text with links: "
+		
+		links_end = num_links * (section + 1) // num_headings
+		while link < links_end:
+			a = etree.SubElement(p, "a")
+			if link%10 == 0:
+				a.set("href", "file://figures/figure%d.png"%link)
+			else:
+				a.set("href", "http://example.com/%d"%link)
+			a.text = "link %d"%link
+			a.tail = ", "
+			link += 1
+	return root
+
+
+# The old, recursive, per-extractor walks
+
+def get_headings(root):
+	headings = []
+	for child in root:
+		if child.tag in ToCExtractorVisitor.HEADINGS:
+			headings.append(child)
+		headings.extend(get_headings(child))
+	return headings
+
+
+def get_resources(root, resources = None):
+	resources = resources if resources is not None else []
+	for child in root:
+		if child.tag in ResourceExtractorVisitor.RESOURCE_TAGS:
+			attrib = ResourceExtractorVisitor.RESOURCE_TAGS[child.tag]
+			if child.attrib[attrib].startswith("file://"):
+				resources.append(child)
+		get_resources(child, resources)
+	return resources
+
+
+def get_text(root):
+	return (root.text or "")\
+	       + "".join(get_text(c) for c in root) \
+	       + (root.tail or "")
+
+
+def get_abstract(root):
+	for child in root:
+		if child.tag == "p":
+			text = get_text(child)
+			if text.strip() != "" and HTML_PLACEHOLDER_RE.match(text) is None:
+				return text
+		ch_abs = get_abstract(child)
+		if ch_abs is not None:
+			return ch_abs
+	return None
+
+
+def recursive_walks(root):
+	get_headings(root)
+	get_resources(root)
+	get_abstract(root)
+
+
+# The same collection using the shared walk
+
+class HeadingsVisitor(TreeVisitor):
+	tags = ToCExtractorVisitor.HEADINGS
+	
+	def start(self, root):
+		self.headings = []
+	
+	def visit(self, element):
+		self.headings.append(element)
+
+
+class ResourcesVisitor(TreeVisitor):
+	tags = ResourceExtractorVisitor.tags
+	
+	def start(self, root):
+		self.resources = []
+	
+	def visit(self, element):
+		attrib = ResourceExtractorVisitor.RESOURCE_TAGS[element.tag]
+		if element.attrib[attrib].startswith("file://"):
+			self.resources.append(element)
+
+
+class Document(object):
+	"""
+	Stands in for the Markdown instance the extractors record their results in.
+	"""
+	pass
+
+
+def shared_walk(visitors):
+	walker = TreeWalkerTreeprocessor(Document())
+	walker.visitors = visitors
+	return walker.run
+
+
+def extractors():
+	md = Document()
+	walker = TreeWalkerTreeprocessor(md)
+	walker.visitors = [
+		ResourceExtractorVisitor(md, {"resource_dir": "resources"}),
+		ToCExtractorVisitor(md),
+		AbstractExtractorVisitor(md),
+	]
+	return walker.run
+
+
+def bench(make_document, process, repeats = 3):
+	"""
+	Return the best time taken by process(root) over a number of freshly built
+	documents.
+	"""
+	best = None
+	for _ in range(repeats):
+		root = make_document()
+		start = time.time()
+		process(root)
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+	return best
+
+
+if __name__=="__main__":
+	num_headings = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	num_links    = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+	
+	methods = [
+		("recursive walks", lambda: recursive_walks),
+		("shared walk",     lambda: shared_walk([HeadingsVisitor(),
+		                                         ResourcesVisitor(),
+		                                         AbstractExtractorVisitor(Document())])),
+		("extractors",      extractors),
+	]
+	
+	print "%d headings, %d links"%(num_headings, num_links)
+	for name, make_process in methods:
+		print "%-18s %8.3f s"%(name + ":",
+		                       bench(lambda: make_document(num_headings, num_links),
+		                             make_process()))
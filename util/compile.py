@@ -5,7 +5,8 @@ Compiler for publications described in markdown format.
 
 Usage:
 
-	compile.py input_file.md [output_path]
+	compile.py [--force] [--svg] [--prerender-math] [--image-formats=webp,avif]
+	           [--asset-store=dir] input_file.md [output_path]
 	
 	Where input-file is a markdown file and output_path is optionally a path to
 	place the output. If left out, output is placed in the current directory. If
@@ -13,6 +14,24 @@ Usage:
 	the article name. Otherwise, the basename of this path is used as the output
 	name and the basepath the location to place the files.
 	
+	With --svg, LaTeX snippets are rendered as SVGs rather than PNGs by default
+	(see mdx_latex.py). Rendered snippets are kept in a hidden directory
+	alongside input_file (.[input_name].latex/). With --prerender-math, math is
+	typeset at compile time rather than by MathJax in the browser (see
+	mdx_mathjax.py).
+	
+	Resized variants of images are generated for use in srcsets (see
+	mdx_responsiveimages.py). --image-formats gives a comma separated list of
+	additional formats (webp and/or avif) to encode them in.
+	
+	Highlighted code blocks are cached (see mdx_highlightcache.py).
+	
+	With --asset-store, assets are added to the given content-addressed store
+	directory (shared between publications) and hard-linked into the output
+	rather than copied so that files used by several publications are stored
+	once. The store should be on the same filesystem as the output (otherwise
+	assets are copied) and is never cleaned up.
+	
 Produces:
 	[output_name].html -- a HTML file containing the body HTML of the publication.
 	[output_name].toc -- a JSON file containing a list of pairs (level, toc_entry, anchor)
@@ -27,49 +46,130 @@ Produces:
 			"abstract" : ,
 			"tags" : ,
 			"show" : ,
+			"mathjax" : ,
 		}
+	[output_name].manifest -- the build manifest (see manifest.py)
+
+Builds are incremental: if the markdown, the files it references, its includes
+and the compiler are unchanged since the output was last built, nothing is done
+(unless --force is given). Otherwise, only assets which have changed are copied.
 """
 
 import markdown
 
 import os
+import sys
+import json
 import errno
+import shutil
+import tempfile
+
+from util import UniqueNames
 
-from util import unique
+from manifest import BuildManifest, hash_data
 
 from subprocess import Popen
 
+from markdown.extensions.codehilite import CodeHiliteExtension
+
+from pygments_css          import STYLE, CSS_CLASS
+
+from mdx_highlightcache    import HighlightCacheExtension
 from mdx_resourceextractor import ResourceExtractor
 from mdx_abstractextractor import AbstractExtractor
 from mdx_tocextractor      import ToCExtractor
 from mdx_mathjax           import MathJaxExtension
 from mdx_latex             import LaTeX
+from mdx_responsiveimages  import ResponsiveImages, ResponsiveImagesTreeprocessor
 
-def process_markdown(input_markdown, output_name, latex_img_dir = "./", input_path = "./", thumb_size=64):
+class MarkdownCompiler(object):
+	"""
+	A Markdown instance configured with the publication extensions which is reused
+	to convert many articles, saving setting it up for each one. The per-article
+	state of Markdown and its extensions (e.g. Meta, the LaTeX preamble and
+	md.resources, md.toc and md.abstract) is reset before each conversion. Not
+	thread safe.
+	
+	LaTeX images and responsive image variants are each generated by a pool of
+	the given number of threads (default: one per CPU).
+	"""
+	
+	def __init__(self, latex_img_format = "png", mathjax_prerender = False,
+	             image_formats = (), threads = None):
+		# Extensions with per-article configuration
+		self.resource_extractor = ResourceExtractor({})
+		self.latex = LaTeX({ "latex_img_format": latex_img_format
+		                   , "latex_jobs": threads
+		                   })
+		
+		self.md = markdown.Markdown( extensions=[ 'meta'
+		                                        , CodeHiliteExtension( css_class = CSS_CLASS
+		                                                             , pygments_style = STYLE
+		                                                             )
+		                                        , HighlightCacheExtension({})
+		                                        , 'tables'
+		                                        , 'def_list'
+		                                        , 'footnotes'
+		                                        , self.resource_extractor
+		                                        , AbstractExtractor()
+		                                        , ToCExtractor()
+		                                        , MathJaxExtension(prerender = mathjax_prerender)
+		                                        , self.latex
+		                                        , ResponsiveImages({ "formats": image_formats
+		                                                           , "jobs": threads
+		                                                           })
+		                                        ]
+		                           )
+	
+	
+	def convert(self, input_markdown, output_name, latex_img_dir = "./",
+	            input_path = "./"):
+		"""
+		Convert an article to HTML. Its other results are left in self.md.
+		"""
+		self.resource_extractor.configs.update({ "resource_dir": output_name
+		                                       , "relative_path": input_path
+		                                       })
+		self.latex.configs.update({ "latex_img_dir": latex_img_dir
+		                          , "input_path": input_path
+		                          })
+		
+		self.md.reset()
+		return self.md.convert(input_markdown)
+
+
+# The MarkdownCompilers created by get_compiler indexed by their options
+compilers = {}
+
+def get_compiler(latex_img_format = "png", mathjax_prerender = False,
+                 image_formats = (), threads = None):
+	"""
+	Return a MarkdownCompiler with the given options, reusing one if it already
+	exists in this process.
+	"""
+	key = (latex_img_format, mathjax_prerender, tuple(image_formats), threads)
+	if key not in compilers:
+		compilers[key] = MarkdownCompiler(*key)
+	return compilers[key]
+
+
+def process_markdown(input_markdown, output_name, latex_img_dir = "./", input_path = "./", thumb_size=64,
+                     latex_img_format = "png", mathjax_prerender = False, image_formats = (),
+                     threads = None):
 	"""
 	Produces the html file, toc file, meta file and a list of (local_file,
 	target_name) pairs where local_file is a file on the local system and
-	target_name is the name of the file when placed in [output_name]/*.
-	"""
-	md = markdown.Markdown( extensions=[ 'meta'
-	                                   , 'codehilite'
-	                                   , 'tables'
-	                                   , 'def_list'
-	                                   , 'footnotes'
-	                                   , ResourceExtractor({ "resource_dir": output_name
-	                                                       , "relative_path": input_path
-	                                                       })
-	                                   , AbstractExtractor()
-	                                   , ToCExtractor()
-	                                   , MathJaxExtension()
-	                                   , LaTeX({ "latex_img_dir": latex_img_dir
-	                                           , "input_path": input_path
-	                                           })
-	                                   ]
-	                      )
+	target_name is the name of the file when placed in [output_name]/*. Also
+	returns the list of includes and the list of local files and directories the
+	output was produced from (besides the markdown itself). Images are generated
+	by the given number of threads (default: one per CPU).
+	"""
+	compiler = get_compiler(latex_img_format, mathjax_prerender, image_formats,
+	                        threads)
+	md = compiler.md
 	
 	# Basic HTML conversion
-	html = md.convert(input_markdown)
+	html = compiler.convert(input_markdown, output_name, latex_img_dir, input_path)
 	
 	# Generate table of contents
 	toc  = md.toc
@@ -103,13 +203,14 @@ def process_markdown(input_markdown, output_name, latex_img_dir = "./", input_pa
 	
 	files = md.resources
 	
+	dependencies = [local_file for (local_file, _) in files] + includes
+	
 	# Add the article image to the list of files and create a thumbnail if
 	# possible.
 	if img is not None and img.startswith("file://"):
 		img = os.path.join(input_path, img[len("file://"):])
-		img_output_name = "%s/%s"%(output_name,
-		                           unique(os.path.basename(img),
-		                                  [f.split("/")[-1] for (_,f) in files]))
+		names = UniqueNames(f.split("/")[-1] for (_,f) in files)
+		img_output_name = "%s/%s"%(output_name, names.allocate(os.path.basename(img)))
 		
 		img_thumbnail = "%s.thumb.png"%img
 		
@@ -125,6 +226,7 @@ def process_markdown(input_markdown, output_name, latex_img_dir = "./", input_pa
 			raise Exception("Creating img thumbnail failed.")
 		
 		files.append((img_thumbnail, img_output_name))
+		dependencies.append(img)
 		img = img_output_name
 	
 	# Generate meta-data
@@ -137,52 +239,135 @@ def process_markdown(input_markdown, output_name, latex_img_dir = "./", input_pa
 		"abstract" : abstract,
 		"tags" : tags,
 		"show" : show,
+		"mathjax" : md.mathjax,
 	}
 	
-	return html, toc, meta_data, files, includes
+	return html, toc, meta_data, files, includes, dependencies
 	
 
 
-
-if __name__=="__main__":
-	import sys, os, shutil
-	import json
+def compile_file(input_markdown_file_name, output_path, output_name, force = False,
+                 asset_store = None, threads = None, **options):
+	"""
+	Compile the named markdown file, producing [output_name].html, .toc, .meta
+	and the [output_name]/ asset directory in output_path. Returns the meta-data.
+	Any options are passed on to process_markdown (e.g. latex_img_format). If an
+	asset_store directory is given, assets are hard-linked from it (see
+	write_output). Images are generated by the given number of threads
+	(default: one per CPU), which doesn't affect the output.
 	
-	# Input comes from stdin
-	if len(sys.argv) > 1 or sys.argv[1] == "-":
-		input_markdown_file_name = sys.argv[1]
-		input_markdown_file = open(input_markdown_file_name)
-	else:
-		input_markdown_file_name = "stdin"
-		input_markdown_file = sys.stdin
+	Unless force is True, nothing is compiled if the build manifest shows that
+	none of the inputs have changed since the last build.
+	"""
+	output_file_name = os.path.join(output_path, output_name)
+	manifest = BuildManifest("%s.manifest"%output_file_name, options)
 	
-	# The input file implies an output name which may be used
-	input_suggested_output_name, _ = os.path.splitext(input_markdown_file_name)
+	outputs = ["%s.%s"%(output_file_name, ext) for ext in ("html", "toc", "meta")]
+	if not force and manifest.up_to_date(outputs):
+		with open("%s.meta"%output_file_name, "r") as f:
+			return json.load(f)
 	
-	# Compiled TeX images should be placed in the same directory as the source
+	# Compiled TeX images should be placed in a directory alongside the source
 	# markdown. This means that they don't have to be re-built every time the file
-	# is compiled.
-	tex_image_path = os.path.dirname(input_markdown_file_name)
+	# is compiled. Each article has its own (hidden) directory as images are named
+	# after their alt-text, which articles compiled concurrently may share.
+	tex_image_path = os.path.join(
+		os.path.dirname(input_markdown_file_name),
+		".%s.latex"%os.path.splitext(os.path.basename(input_markdown_file_name))[0])
+	try:
+		os.makedirs(tex_image_path)
+	except OSError:
+		# Directory exists
+		pass
 	
-	# Output goes to what name...
-	if len(sys.argv) > 2:
-		output_path = sys.argv[2]
-		if output_path.endswith("/"):
-			output_name = input_suggested_output_name
-		else:
-			output_name = os.path.basename(output_path)
-			output_path = os.path.dirname(output_path)
-	else:
-		output_path = "."
-		output_name = input_suggested_output_name
+	with open(input_markdown_file_name, "r") as f:
+		input_markdown = f.read()
 	
-	output_file_name = os.path.join(output_path, output_name)
+	html, toc, meta, files, includes, dependencies = \
+		process_markdown( input_markdown
+		                , output_name
+		                , tex_image_path
+		                , os.path.dirname(input_markdown_file_name)
+		                , threads = threads
+		                , **options
+		                )
+	
+	manifest.add_input(input_markdown_file_name)
+	for path in dependencies:
+		manifest.add_input(path)
+	
+	write_output(output_path, output_name, html, toc, meta, files, includes, manifest,
+	             asset_store)
+	
+	manifest.save()
+	
+	return meta
+
+
+def store_asset(asset_store, local_path, file_hash):
+	"""
+	Add a file with the given content hash to a content-addressed store directory
+	(unless already present) and return its path in the store.
+	"""
+	store_dir = os.path.join(asset_store, file_hash[:2])
+	store_file = os.path.join(store_dir, file_hash + os.path.splitext(local_path)[1])
+	if os.path.isfile(store_file):
+		return store_file
+	
+	try:
+		os.makedirs(store_dir)
+	except OSError:
+		# Directory exists
+		pass
+	
+	# Atomically add to the store as it may be shared by concurrent builds
+	fd, tmp_file = tempfile.mkstemp(dir = store_dir, suffix = ".tmp")
+	os.close(fd)
+	try:
+		shutil.copy(local_path, tmp_file)
+		os.rename(tmp_file, store_file)
+	finally:
+		# Don't leave the temporary file behind if the copy failed
+		if os.path.exists(tmp_file):
+			os.remove(tmp_file)
 	
-	html, toc, meta, files, includes = process_markdown( input_markdown_file.read()
-	                                                   , output_name
-	                                                   , tex_image_path
-	                                                   , os.path.dirname(input_markdown_file_name)
-	                                                   )
+	return store_file
+
+
+def copy_asset(local_path, target_path, asset_store = None, file_hash = None):
+	"""
+	Copy a file to target_path, by hard-linking it from the asset_store directory
+	if one is given.
+	"""
+	# Never write through an existing copy: it may be a link into the store
+	if os.path.lexists(target_path):
+		os.remove(target_path)
+	
+	if asset_store is not None:
+		if file_hash is None:
+			with open(local_path, "rb") as f:
+				file_hash = hash_data(f.read())
+		store_file = store_asset(asset_store, local_path, file_hash)
+		try:
+			os.link(store_file, target_path)
+			return
+		except OSError:
+			# E.g. the store is on another filesystem
+			pass
+		local_path = store_file
+	
+	shutil.copy(local_path, target_path)
+
+
+def write_output(output_path, output_name, html, toc, meta, files, includes,
+                 manifest = None, asset_store = None):
+	"""
+	Write the results of process_markdown into output_path. If a BuildManifest is
+	given, assets which are unchanged since they were last copied are skipped. If
+	an asset_store directory is given, assets are hard-linked from it rather than
+	copied (see store_asset).
+	"""
+	output_file_name = os.path.join(output_path, output_name)
 	
 	# Make output file directory
 	try:
@@ -210,17 +395,27 @@ if __name__=="__main__":
 	# Copy files into output file directory
 	for local_path, target_path in files:
 		target_path = os.path.join(output_path, target_path)
+		if manifest is not None and not manifest.copy_needed(local_path, target_path):
+			continue
 		try:
-			shutil.copy(local_path, target_path)
-		except IOError as e:
-			sys.stderr.write("WARNING: Could not copy %s to %s: %s\n"%(
+			copy_asset(local_path, target_path, asset_store,
+			           manifest.hash(local_path) if manifest is not None else None)
+		except (IOError, OSError) as e:
+			raise IOError("Could not copy %s to %s: %s"%(
 				local_path, target_path, repr(e)
 			))
-			sys.exit(1)
 	
 	# Copy includes into the output directory
 	for path in includes:
 		dest = os.path.join(output_path, output_name, os.path.basename(path.rstrip("/")))
+		if manifest is not None:
+			if not manifest.copy_needed(path, dest):
+				continue
+			# Replace the out-of-date copy
+			if os.path.isdir(dest):
+				shutil.rmtree(dest)
+			elif os.path.exists(dest):
+				os.remove(dest)
 		try:
 			shutil.copytree(path, dest)
 		except OSError as exc:
@@ -228,3 +423,77 @@ if __name__=="__main__":
 				shutil.copy(path, dest)
 			else:
 				raise
+
+
+def parse_image_formats(value):
+	"""
+	Parse the value of an --image-formats argument (a comma separated list),
+	exiting with an error if any of the formats is not supported.
+	"""
+	formats = [fmt.strip().lower() for fmt in value.split(",") if fmt.strip()]
+	supported = ResponsiveImagesTreeprocessor.MIME_TYPES
+	unknown = [fmt for fmt in formats if fmt not in supported]
+	if unknown:
+		sys.stderr.write("Unsupported image format(s): %s (expected %s).\n"%(
+			", ".join(unknown), " and/or ".join(sorted(supported))))
+		sys.exit(1)
+	return formats
+
+
+
+if __name__=="__main__":
+	args = sys.argv[1:]
+	
+	force = False
+	asset_store = None
+	options = {}
+	while args and args[0].startswith("--"):
+		flag = args.pop(0)
+		if flag == "--force":
+			force = True
+		elif flag == "--svg":
+			options["latex_img_format"] = "svg"
+		elif flag == "--prerender-math":
+			options["mathjax_prerender"] = True
+		elif flag.startswith("--image-formats="):
+			options["image_formats"] = parse_image_formats(flag.partition("=")[2])
+		elif flag.startswith("--asset-store="):
+			asset_store = flag.partition("=")[2]
+		else:
+			sys.stderr.write(__doc__)
+			sys.exit(1)
+	
+	# Input comes from stdin
+	if len(args) > 0 and args[0] != "-":
+		input_markdown_file_name = args[0]
+	else:
+		input_markdown_file_name = "stdin"
+	
+	# The input file implies an output name which may be used
+	input_suggested_output_name, _ = os.path.splitext(input_markdown_file_name)
+	
+	# Output goes to what name...
+	if len(args) > 1:
+		output_path = args[1]
+		if output_path.endswith("/"):
+			output_name = input_suggested_output_name
+		else:
+			output_name = os.path.basename(output_path)
+			output_path = os.path.dirname(output_path)
+	else:
+		output_path = "."
+		output_name = input_suggested_output_name
+	
+	try:
+		if input_markdown_file_name == "stdin":
+			# Nothing to track dependencies against: always build
+			html, toc, meta, files, includes, dependencies = \
+				process_markdown(sys.stdin.read(), output_name, **options)
+			write_output(output_path, output_name, html, toc, meta, files, includes,
+			             asset_store = asset_store)
+		else:
+			compile_file(input_markdown_file_name, output_path, output_name, force,
+			             asset_store, **options)
+	except IOError as e:
+		sys.stderr.write("WARNING: %s\n"%e)
+		sys.exit(1)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Build manifests which allow publications to be rebuilt incrementally.
+
+A manifest records the compiler version, content hashes of every input an
+article was built from (the markdown, referenced files, includes and the article
+image) and of every asset copied into its output directory. An article need only
+be rebuilt if any of these have changed and an asset need only be copied if its
+source has changed.
+
+To keep no-op builds fast, the hash of each file is stored along with its size
+and mtime and is only recomputed when these change.
+"""
+
+import markdown
+
+import os
+import json
+import glob
+import hashlib
+
+
+def hash_data(data):
+	return hashlib.sha1(data).hexdigest()
+
+
+def compiler_version():
+	"""
+	A hash identifying the version of the compiler: the source of the compiler,
+	its markdown extensions and every other module of util/ which they use, along
+	with the version of markdown in use.
+	"""
+	util_dir = os.path.dirname(os.path.abspath(__file__))
+	file_names = [os.path.join(util_dir, "compile.py"),
+	              os.path.join(util_dir, "util.py"),
+	              os.path.join(util_dir, "manifest.py"),
+	              os.path.join(util_dir, "rasterise.py"),
+	              os.path.join(util_dir, "pygments_css.py")]
+	file_names += sorted(glob.glob(os.path.join(util_dir, "mdx_*.py")))
+	
+	h = hashlib.sha1(markdown.__version__)
+	for file_name in file_names:
+		with open(file_name, "rb") as f:
+			h.update(f.read())
+	return h.hexdigest()
+
+
+COMPILER_VERSION = compiler_version()
+
+
+class BuildManifest(object):
+	"""
+	The build manifest of a single article, stored as a JSON file:
+	
+		{
+			"compiler": COMPILER_VERSION,
+			"settings": {...},
+			"inputs": {path: hash, ...},
+			"copies": {target_path: hash_of_source, ...},
+			"stats": {path: [size, mtime, hash], ...},
+		}
+	
+	settings are any compiler options which affect the output.
+	
+	The hash of a directory covers the names and contents of all files within it.
+	The hash of a missing file is None.
+	"""
+	
+	def __init__(self, file_name, settings = None):
+		self.file_name = file_name
+		self.settings  = settings or {}
+		
+		try:
+			with open(file_name, "r") as f:
+				self.old = json.load(f)
+		except (IOError, ValueError):
+			self.old = {}
+		
+		self.old_stats = self.old.get("stats", {})
+		
+		self.inputs = {}
+		self.copies = {}
+		self.stats  = {}
+	
+	
+	def hash(self, path):
+		"""
+		Return the content hash of the named file or directory.
+		"""
+		if os.path.isdir(path):
+			h = hashlib.sha1()
+			for dir_path, dir_names, file_names in os.walk(path):
+				dir_names.sort()
+				for file_name in sorted(file_names):
+					file_path = os.path.join(dir_path, file_name)
+					h.update(os.path.relpath(file_path, path))
+					h.update(self.hash(file_path) or "")
+			return h.hexdigest()
+		
+		if path in self.stats:
+			return self.stats[path][2]
+		
+		try:
+			st = os.stat(path)
+		except OSError:
+			return None
+		
+		old_stat = self.old_stats.get(path)
+		if old_stat is not None and old_stat[:2] == [st.st_size, st.st_mtime]:
+			file_hash = old_stat[2]
+		else:
+			with open(path, "rb") as f:
+				file_hash = hash_data(f.read())
+		
+		self.stats[path] = [st.st_size, st.st_mtime, file_hash]
+		return file_hash
+	
+	
+	def up_to_date(self, outputs):
+		"""
+		Are the given output files present and were they built by this version of
+		the compiler from inputs which have not changed since?
+		"""
+		if self.old.get("compiler") != COMPILER_VERSION:
+			return False
+		
+		if self.old.get("settings", {}) != self.settings:
+			return False
+		
+		if not all(os.path.isfile(output) for output in outputs):
+			return False
+		
+		old_inputs = self.old.get("inputs")
+		if not old_inputs:
+			return False
+		
+		for path, old_hash in old_inputs.iteritems():
+			if self.hash(path) != old_hash:
+				return False
+		
+		return True
+	
+	
+	def add_input(self, path):
+		"""
+		Record that the output depends on the named file or directory.
+		"""
+		self.inputs[path] = self.hash(path)
+	
+	
+	def copy_needed(self, source, target):
+		"""
+		Record that source is to be copied to target and return False if target is
+		already a copy of the current version of source.
+		"""
+		source_hash = self.hash(source)
+		self.copies[target] = source_hash
+		return not (os.path.exists(target)
+		            and source_hash is not None
+		            and self.old.get("copies", {}).get(target) == source_hash)
+	
+	
+	def save(self):
+		"""
+		Atomically write the manifest.
+		"""
+		manifest = {
+			"compiler": COMPILER_VERSION,
+			"settings": self.settings,
+			"inputs": self.inputs,
+			"copies": self.copies,
+			"stats": self.stats,
+		}
+		with open(self.file_name + ".tmp", "w") as f:
+			json.dump(manifest, f)
+		os.rename(self.file_name + ".tmp", self.file_name)
@@ -4,39 +4,38 @@
 Markdown extension which extracts the first paragraph (i.e. the abstract)
 """
 
-from markdown.treeprocessors import Treeprocessor
-from markdown.extensions     import Extension
-from markdown.util           import HTML_PLACEHOLDER_RE
+from markdown.extensions import Extension
+from markdown.util       import HTML_PLACEHOLDER_RE
 
-class AbstractExtractorTreeprocessor(Treeprocessor):
+from mdx_treewalk import TreeVisitor, register_visitor
+
+class AbstractExtractorVisitor(TreeVisitor):
+	
+	tags = frozenset(["p"])
+	
 	
 	def __init__(self, md):
 		self.md = md
 	
 	
-	def get_text(self, root):
-		return (root.text or "")\
-		       + "".join(self.get_text(c) for c in root) \
-		       + (root.tail or "")
+	def get_text(self, element):
+		return "".join(element.itertext()) + (element.tail or "")
+	
 	
+	def start(self, root):
+		self.abstract = None
 	
-	def get_abstract(self, root):
-		for child in root:
-			if child.tag == "p":
-				text = self.get_text(child)
-				if text.strip() != "" and HTML_PLACEHOLDER_RE.match(text) is None:
-					return text
-			
-			ch_abs = self.get_abstract(child)
-			if ch_abs is not None:
-				return ch_abs
-		
-		return None
 	
+	def visit(self, element):
+		# The first non-empty paragraph which isn't just raw HTML
+		if self.abstract is None:
+			text = self.get_text(element)
+			if text.strip() != "" and HTML_PLACEHOLDER_RE.match(text) is None:
+				self.abstract = text
 	
-	def run(self, root):
-		self.md.abstract = self.get_abstract(root)
-		return root
+	
+	def finish(self, root):
+		self.md.abstract = self.abstract
 
 
 class AbstractExtractor(Extension):
@@ -45,7 +44,13 @@ class AbstractExtractor(Extension):
 		pass
 	
 	def extendMarkdown(self, md, md_globals={}):
-		md.treeprocessors.register(AbstractExtractorTreeprocessor(md), 'absextractor', -100)
+		self.md = md
+		md.registerExtension(self)
+		register_visitor(md, AbstractExtractorVisitor(md))
+		self.reset()
+	
+	def reset(self):
+		self.md.abstract = None
 
 
 def makeExtension(**kwargs):
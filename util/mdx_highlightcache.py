@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+Markdown extension which caches the code blocks highlighted by codehilite.
+
+The HTML produced for each block is kept in a cache directory,
+configs["cache_dir"] (default: $JHNET_HIGHLIGHT_CACHE or
+~/.cache/jhnet_highlight), keyed by a hash of the block's source (including any
+":::language" or shebang line which selects the lexer), codehilite's options and
+the versions of Pygments and Markdown (which includes codehilite). Blocks found
+in the cache are substituted just before codehilite runs, so Pygments is only
+invoked for the rest, whose output is added to the cache just after.
+
+The codehilite extension must also be used. Publications are highlighted with
+the Pygments style STYLE and CSS class CSS_CLASS defined in pygments_css.py,
+which generates the matching stylesheet.
+"""
+
+import markdown
+
+from markdown.treeprocessors import Treeprocessor
+from markdown.extensions     import Extension
+from markdown.util           import HTML_PLACEHOLDER_RE
+
+try:
+	import pygments
+	PYGMENTS_VERSION = pygments.__version__
+except ImportError:
+	PYGMENTS_VERSION = None
+
+import tempfile
+import hashlib
+import os
+
+DEFAULT_CACHE_DIR = os.environ.get("JHNET_HIGHLIGHT_CACHE",
+                                   os.path.expanduser("~/.cache/jhnet_highlight"))
+
+
+class HighlightCache(object):
+	"""
+	A directory of highlighted HTML keyed by hashes.
+	"""
+	
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+	
+	
+	def get(self, key):
+		"""
+		Return the HTML cached under the given key or None if there is none.
+		"""
+		try:
+			with open(os.path.join(self.cache_dir, "%s.html"%key), "rb") as f:
+				return f.read().decode("utf-8")
+		except IOError:
+			return None
+	
+	
+	def put(self, key, html):
+		if not os.path.isdir(self.cache_dir):
+			try:
+				os.makedirs(self.cache_dir)
+			except OSError:
+				# Created concurrently
+				pass
+		fd, tmp_file = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+		with os.fdopen(fd, "wb") as f:
+			f.write(html.encode("utf-8"))
+		os.rename(tmp_file, os.path.join(self.cache_dir, "%s.html"%key))
+
+
+class HighlightLookupTreeprocessor(Treeprocessor):
+	"""
+	Runs before codehilite, replacing the code blocks found in the cache with
+	their HTML (as codehilite would) and recording the others in self.misses as
+	(element, key) pairs.
+	"""
+	
+	def __init__(self, md, cache):
+		self.md = md
+		self.cache = cache
+		self.misses = []
+	
+	
+	def run(self, root):
+		self.misses = []
+		
+		if "hilite" not in self.md.treeprocessors:
+			return root
+		
+		options = (sorted(self.md.treeprocessors["hilite"].config.items()),
+		           self.md.tab_length,
+		           PYGMENTS_VERSION,
+		           markdown.__version__)
+		
+		for block in list(root.iter("pre")):
+			if len(block) == 1 and block[0].tag == "code":
+				key = hashlib.sha1(repr((block[0].text, options))).hexdigest()
+				html = self.cache.get(key)
+				if html is None:
+					self.misses.append((block, key))
+				else:
+					block.clear()
+					block.tag = "p"
+					block.text = self.md.htmlStash.store(html)
+		
+		return root
+
+
+class HighlightStoreTreeprocessor(Treeprocessor):
+	"""
+	Runs after codehilite, adding the HTML it produced for the blocks which were
+	not in the cache to the cache.
+	"""
+	
+	def __init__(self, md, cache, lookup):
+		self.md = md
+		self.cache = cache
+		self.lookup = lookup
+	
+	
+	def run(self, root):
+		for block, key in self.lookup.misses:
+			# codehilite replaces the block with a placeholder for its HTML
+			match = HTML_PLACEHOLDER_RE.match(block.text or "")
+			if block.tag == "p" and match is not None:
+				self.cache.put(key, self.md.htmlStash.rawHtmlBlocks[int(match.group(1))])
+		
+		self.lookup.misses = []
+		return root
+
+
+class HighlightCacheExtension(Extension):
+	
+	def __init__(self, configs):
+		self.configs = dict(configs)
+	
+	def extendMarkdown(self, md, md_globals={}):
+		cache = HighlightCache(self.configs.get("cache_dir", DEFAULT_CACHE_DIR))
+		self.lookup = HighlightLookupTreeprocessor(md, cache)
+		
+		# Either side of codehilite's treeprocessor (priority 30)
+		md.treeprocessors.register(self.lookup, 'highlightlookup', 31)
+		md.treeprocessors.register(HighlightStoreTreeprocessor(md, cache, self.lookup),
+		                           'highlightstore', 29)
+		md.registerExtension(self)
+	
+	def reset(self):
+		self.lookup.misses = []
+
+
+def makeExtension(**kwargs):
+	return HighlightCacheExtension(kwargs.get("configs", {}))
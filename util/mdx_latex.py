@@ -17,20 +17,59 @@ from the alt-text.
 If the alt-text given is "<preamble>", the code is not rendered but added to the
 preamble of all succeeding latex blocks.
 
-The PNG file will be placed in the directory configs["latex_img_dir"].
+The image will be placed in the directory configs["latex_img_dir"]. Flags may be
+added to the alt-text:
+
+	--pdf -- make the image a link to the PDF of the rendered LaTeX
+	--svg -- produce an SVG rather than a PNG
+	--png -- produce a PNG, even if configs["latex_img_format"] is "svg"
+
+Images are PNGs unless configs["latex_img_format"] is "svg".
+
+PDFs are converted to PNGs by the first available backend in rasterise.py
+(pdftocairo, pdftoppm or ImageMagick's convert) unless one is named by
+configs["latex_rasteriser"]. Likewise, SVGs are produced by dvisvgm, pdftocairo
+or pdf2svg unless configs["latex_svg_converter"] names one.
+
+Rendered images are kept in a content-addressed cache directory,
+configs["latex_cache_dir"] (default: $JHNET_LATEX_CACHE or ~/.cache/jhnet_latex),
+keyed by a hash of the complete LaTeX source, the directory it is compiled in
+(configs["input_path"]) and the rendering settings. Each snippet is rendered
+once no matter which article (or alt-text) it appears under and is then
+hard-linked (or copied) into place. Snippets which read other files (e.g. with
+\input or \includegraphics, see READS_FILES_RE) are not cached as their output
+changes when those files do.
+
+Snippets are rendered concurrently by a pool of configs["latex_jobs"] (default:
+one per CPU) worker threads. The image is referenced in the document straight
+away while its rendering is queued; all renderings are waited for by a
+treeprocessor (priority 5) which runs before those which read the rendered
+files (e.g. the resource extractor and responsive images). Each snippet is
+rendered with the preamble defined above it.
+
+The fixed part of the preamble (LATEX_PREAMBLE) is precompiled into a TeX format
+file using the mylatexformat package. The format is kept in the cache directory,
+named by a hash of the preamble and the pdflatex version. If the format can't be
+built, snippets are compiled without one. pdflatex is only re-run when the log
+asks for it.
 """
 
 from markdown.blockprocessors import BlockProcessor
+from markdown.treeprocessors  import Treeprocessor
 from markdown.extensions      import Extension
 
 from util import slugify
 
 from mako.template import Template
 
-from subprocess import Popen
+from subprocess import Popen, PIPE
+
+import rasterise
 
-from PIL import Image, PngImagePlugin
+from multiprocessing.pool import ThreadPool
 
+import multiprocessing
+import threading
 import hashlib
 
 import re
@@ -48,13 +87,31 @@ class LaTeXBlockProcessor(BlockProcessor):
 	                      + r"^\\end\{latex\}\s*"
 	                     , re.MULTILINE | re.DOTALL)
 	
-	# How many times to build with latex
+	# The maximum number of times to build with latex. Further builds are only
+	# made while the log contains a message matching LATEX_RERUN_RE.
 	LATEX_BUILDS = 2
+	LATEX_RERUN_RE = re.compile(r"Rerun to get|Please rerun|Rerun LaTeX"
+	                            r"|may have changed\. Rerun")
 	
-	# A template for a latex file that renders to one file
-	LATEX_TEMPLATE = Template(r"""
-		%% Only build the bare minimum
-		%%\documentclass{minimal}
+	# Matches LaTeX which reads other files (or runs commands), whose renderings
+	# are never cached.
+	READS_FILES_RE = re.compile(r"\\(?:input|include|includegraphics|includepdf"
+	                            r"|includestandalone|lstinputlisting|verbatiminput"
+	                            r"|inputminted|import|subimport|subfile|openin"
+	                            r"|write18|pgfplotstableread)(?![a-zA-Z])"
+	                            r"|\\addplot[^;]*\b(?:table|file)\b")
+	
+	# Resolution at which the PDF is rasterised (the rasteriser backend used may
+	# be chosen with configs["latex_rasteriser"], see rasterise.py)
+	DPI = 110
+	
+	DEFAULT_CACHE_DIR = os.environ.get("JHNET_LATEX_CACHE",
+	                                   os.path.expanduser("~/.cache/jhnet_latex"))
+	
+	# The fixed preamble of every latex file, which is precompiled into a format.
+	LATEX_PREAMBLE = r"""
+		% Only build the bare minimum
+		%\documentclass{minimal}
 		\documentclass[border=0pt,12pt]{standalone}
 		
 		\usepackage{amsmath}
@@ -83,6 +140,14 @@ class LaTeXBlockProcessor(BlockProcessor):
 		               , shapes
 		               , arrows
 		               }
+	"""
+	
+	# A template for a latex file that renders to one file. When compiled with the
+	# format, everything up to \endofdump is skipped.
+	LATEX_TEMPLATE = Template(r"""
+		${fixed_preamble}
+		
+		\csname endofdump\endcsname
 		
 		${preamble}
 		
@@ -92,112 +157,284 @@ class LaTeXBlockProcessor(BlockProcessor):
 	""")
 	
 	
+	# Names of the formats built by this process (or None where building the
+	# format failed) indexed by cache directory.
+	formats      = {}
+	formats_lock = threading.Lock()
+	
+	
 	def __init__(self, configs, *args, **kwargs):
-		self.configs = dict(configs)
+		# Shared with the extension so that it may be reconfigured between documents
+		self.configs = configs
 		BlockProcessor.__init__(self, *args, **kwargs)
 		
 		# LaTeX preamble
 		self.preamble = ""
+		
+		# Pool of threads running renderings (created on demand) and the
+		# AsyncResults of the renderings queued.
+		self.pool = None
+		self.renders = []
+	
+	
+	def reset(self):
+		"""
+		Forget the preamble and any renderings left queued by a conversion which
+		failed, ready for the next document.
+		"""
+		self.preamble = ""
+		
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+			self.renders = []
+	
+	
+	def place_file(self, cached_file, output_file):
+		"""
+		Make output_file a copy of cached_file, by hard-linking it if possible. Does
+		nothing if it already is one (same inode, or same size and mtime as left by
+		a previous copy).
+		"""
+		try:
+			cached_st = os.stat(cached_file)
+			output_st = os.stat(output_file)
+			if ((cached_st.st_dev, cached_st.st_ino) == (output_st.st_dev, output_st.st_ino)
+			    or (cached_st.st_size, cached_st.st_mtime) == (output_st.st_size, output_st.st_mtime)):
+				return
+			os.remove(output_file)
+		except OSError:
+			# Output doesn't exist yet
+			pass
+		
+		try:
+			os.link(cached_file, output_file)
+		except OSError:
+			# E.g. the cache is on another filesystem
+			shutil.copy2(cached_file, output_file)
+	
+	
+	def queue_render(self, latex_snippet, output_img_file, output_pdf_file,
+	                 img_format = "png"):
+		"""
+		Queue the rendering of a snippet of latex (see render_latex) on the worker
+		pool. The tex is generated immediately so that it uses the preamble as it
+		stands at this point in the document.
+		"""
+		tex = LaTeXBlockProcessor.LATEX_TEMPLATE.render(
+			fixed_preamble = LaTeXBlockProcessor.LATEX_PREAMBLE,
+			preamble = self.preamble,
+			document = latex_snippet,
+		)
+		
+		if self.pool is None:
+			self.pool = ThreadPool(self.configs.get("latex_jobs")
+			                       or multiprocessing.cpu_count())
+		
+		self.renders.append(self.pool.apply_async(
+			self.render_latex, (tex, latex_snippet, output_img_file, output_pdf_file,
+			                    img_format)))
+	
+	
+	def wait(self):
+		"""
+		Wait for all queued renderings to complete. If any failed, the first
+		failure is re-raised (once the others have finished).
+		"""
+		if self.pool is None:
+			return
+		
+		try:
+			for render in self.renders:
+				render.get()
+		finally:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+			self.renders = []
 	
 	
-	def set_png_metadata(self, png_filename, metadata):
+	def render_latex(self, tex, latex_snippet, output_img_file, output_pdf_file,
+	                 img_format = "png"):
 		"""
-		Takes a PNG filename and overwrites the fields specified in metadata with
-		the values given, adding any new fields.
+		Takes the tex for a snippet of latex and produces an image in img_format
+		("png" or "svg") (and optionally a pdf) at the filenames specified.
+		Renderings are cached by the hash of the tex, the directory it is compiled
+		in and rendering settings so a snippet is only compiled if it has never been
+		rendered before (unless it reads other files, see READS_FILES_RE).
 		"""
-		im = Image.open(png_filename)
+		tex_hash = hashlib.sha1(tex).hexdigest()
 		
-		# This hack works-around PIL's broken png metadata support. Disovered here:
-		# http://blog.client9.com/2007/08/python-pil-and-png-metadata-take-2.html
-		meta = PngImagePlugin.PngInfo()
+		if img_format == "svg":
+			converter = rasterise.get_backend(self.configs.get("latex_svg_converter"),
+			                                  rasterise.SVG_BACKENDS, "SVG converter")
+			settings = (img_format, converter[0])
+		else:
+			converter = rasterise.get_backend(self.configs.get("latex_rasteriser"))
+			settings = (LaTeXBlockProcessor.DPI, converter[0])
 		
-		# These meta-data entries are added (eroneously) by PIL, ignore them
-		reserved = ('interlace', 'gamma', 'dpi', 'transparency', 'aspect')
+		cache_dir = self.configs.get("latex_cache_dir",
+		                             LaTeXBlockProcessor.DEFAULT_CACHE_DIR)
 		
-		# Add in the new metadata
-		img_metadata = im.info.copy()
-		img_metadata.update(metadata)
+		if LaTeXBlockProcessor.READS_FILES_RE.search(tex):
+			# Build afresh every time (in a private directory rather than the cache)
+			build_dir = tempfile.mkdtemp(prefix = "mdx_latex_uncached_")
+			try:
+				img_file = os.path.join(build_dir, "file.%s"%img_format)
+				pdf_file = os.path.join(build_dir, "file.pdf")
+				self.build_latex(tex, tex_hash, latex_snippet, cache_dir,
+				                 img_format, converter, img_file, pdf_file)
+				self.place_file(img_file, output_img_file)
+				if output_pdf_file is not None:
+					self.place_file(pdf_file, output_pdf_file)
+			finally:
+				shutil.rmtree(build_dir)
+			return
 		
-		# Add to the PNG
-		for k,v in img_metadata.iteritems():
-			if k not in reserved:
-				meta.add_text(k,v)
+		# The snippet is compiled in input_path (so relative paths are resolved
+		# against it, e.g. by packages)
+		input_path = os.path.realpath(self.configs.get("input_path", "./"))
 		
-		# Write it out
-		im.save(png_filename, pnginfo=meta)
+		cache_key = hashlib.sha1(repr((tex, input_path) + settings)).hexdigest()
+		cached_img_file = os.path.join(cache_dir, "%s.%s"%(cache_key, img_format))
+		cached_pdf_file = os.path.join(cache_dir, "%s.pdf"%cache_key)
+		
+		if not os.path.isfile(cached_img_file):
+			self.build_latex(tex, tex_hash, latex_snippet, cache_dir,
+			                 img_format, converter,
+			                 cached_img_file, cached_pdf_file)
+		
+		self.place_file(cached_img_file, output_img_file)
+		if output_pdf_file is not None:
+			self.place_file(cached_pdf_file, output_pdf_file)
 	
 	
-	def get_png_metadata(self, png_filename):
+	def get_format(self, cache_dir):
 		"""
-		Takes a PNG filename and returns the metadata fields it contains as a dict.
+		Return the name of a format in cache_dir with LATEX_PREAMBLE precompiled,
+		building it if it doesn't exist yet, or None if it can't be built (e.g.
+		mylatexformat isn't installed).
 		"""
-		return Image.open(png_filename).info.copy()
+		with LaTeXBlockProcessor.formats_lock:
+			if cache_dir in LaTeXBlockProcessor.formats:
+				return LaTeXBlockProcessor.formats[cache_dir]
+			
+			# Formats are only usable by the version of TeX which made them
+			version = Popen(["pdflatex", "--version"], stdout = PIPE).communicate()[0]
+			name = "preamble_%s"%(
+				hashlib.sha1(LaTeXBlockProcessor.LATEX_PREAMBLE + version).hexdigest()[:20])
+			
+			fmt_file = os.path.join(cache_dir, "%s.fmt"%name)
+			if not os.path.isfile(fmt_file):
+				tmp_dir = tempfile.mkdtemp(prefix = "mdx_latex_fmt_")
+				try:
+					with open(os.path.join(tmp_dir, "preamble.tex"), "w") as f:
+						f.write(LaTeXBlockProcessor.LATEX_PREAMBLE)
+						f.write("\n\\endofdump\n")
+					
+					p = Popen( [ "pdflatex"
+					           , "-ini"
+					           , "-jobname=%s"%name
+					           , "&pdflatex"
+					           , "mylatexformat.ltx"
+					           , "preamble.tex"]
+					         , cwd    = tmp_dir
+					         , stdin  = None
+					         , stdout = sys.stderr
+					         , stderr = sys.stderr
+					         )
+					if p.wait() == 0:
+						tmp_fmt_file = os.path.join(cache_dir, "%s.%s.tmp"%(
+							name, os.path.basename(tmp_dir)))
+						shutil.copy(os.path.join(tmp_dir, "%s.fmt"%name), tmp_fmt_file)
+						os.rename(tmp_fmt_file, fmt_file)
+					else:
+						sys.stderr.write("WARNING: Could not build LaTeX format, "
+						                 "compiling without one.\n")
+						name = None
+				finally:
+					shutil.rmtree(tmp_dir)
+			
+			LaTeXBlockProcessor.formats[cache_dir] = name
+			return name
 	
 	
-	def render_latex(self, latex_snippet, output_png_file, output_pdf_file):
+	def build_latex(self, tex, tex_hash, latex_snippet, cache_dir,
+	                img_format, converter, cached_img_file, cached_pdf_file):
 		"""
-		Takes a snippet of latex and produces a png at the filename specified. This
-		method is lazy, if the tex has not changed since the last run, it is not
-		compiled. This is detected by checking a hash of the tex added to the PNG
-		metadata.
+		Compile the given tex and store the PDF and the image (produced from it by
+		the given rasterise backend) in the cache.
 		"""
+		if not os.path.isdir(cache_dir):
+			try:
+				os.makedirs(cache_dir)
+			except OSError:
+				# Created concurrently
+				pass
+		
+		fmt = self.get_format(cache_dir)
+		
 		tmp_dir = tempfile.mkdtemp(prefix = "mdx_latex_")
 		tex_file = os.path.join(tmp_dir, "file.tex")
+		log_file = os.path.join(tmp_dir, "file.log")
 		pdf_file = os.path.join(tmp_dir, "file.pdf")
+		img_file = os.path.join(tmp_dir, "file.%s"%img_format)
+		
+		latex_command = [ "pdflatex"
+		                , "-shell-escape"
+		                , "-halt-on-error"
+		                , "-output-directory", tmp_dir
+		                ]
+		latex_env = None
+		if fmt is not None:
+			latex_command.append("-fmt=%s"%fmt)
+			latex_env = dict(os.environ, TEXFORMATS = cache_dir + os.pathsep)
 		
 		try:
-			# Generate the tex file
-			tex = LaTeXBlockProcessor.LATEX_TEMPLATE.render(
-				preamble = self.preamble,
-				document = latex_snippet,
-			)
-			tex_hash = hashlib.sha1(tex).hexdigest()
-			
-			# Check if anything needs to be done
-			try:
-				png_meta = self.get_png_metadata(output_png_file)
-				if tex_hash == png_meta.get("tex_hash", None):
-					# Already got the latest version in the PNG, do nothing!
-					return
-			except IOError:
-				# No file exists yet so we definately should build it
-				pass
-			
-			
 			# Store the tex in a file to be compiled
 			with open(tex_file, "w") as f:
 				f.write(tex)
 			
 			# Try and build the file
 			for build_num in range(LaTeXBlockProcessor.LATEX_BUILDS):
-				p = Popen( [ "pdflatex"
-				           , "-shell-escape"
-				           , "-halt-on-error"
-				           , "-output-directory", tmp_dir
-				           , tex_file]
+				p = Popen( latex_command + [tex_file]
 				         , cwd    = os.path.realpath(self.configs.get("input_path", "./"))
+				         , env    = latex_env
 				         , stdin  = None
 				         , stdout = sys.stderr
 				         , stderr = sys.stderr
 				         )
 				if p.wait() != 0:
 					raise Exception("LaTeX Compilation Failed for:\n%s"%latex_snippet)
+				
+				# Stop unless LaTeX asks to be re-run (e.g. for cross-references)
+				with open(log_file, "r") as f:
+					if not LaTeXBlockProcessor.LATEX_RERUN_RE.search(f.read()):
+						break
 			
-			# Make a copy of required
-			if output_pdf_file is not None:
-				shutil.copy(pdf_file, output_pdf_file)
+			# Convert to the image format
+			converter_name, convert_pdf = converter
+			try:
+				if img_format == "svg":
+					convert_pdf(pdf_file, img_file)
+				else:
+					convert_pdf(pdf_file, img_file, LaTeXBlockProcessor.DPI)
+			except Exception:
+				raise Exception("Converting PDF to %s (with %s) failed for:\n%s"%(
+					img_format.upper(), converter_name, latex_snippet))
 			
-			# Convert to PNG
-			p = Popen( ["convert", "-density", "440", pdf_file, "-resize", "25%", output_png_file]
-			         , stdin  = None
-			         , stdout = sys.stderr
-			         , stderr = sys.stderr
-			         )
-			if p.wait() != 0:
-				raise Exception("Converting PDF to PNG failed for:\n%s"%latex_snippet)
+			if img_format == "png":
+				# Add the hash of the source to the metadata 
+				rasterise.set_png_text(img_file, {"tex_hash":tex_hash})
 			
-			# Add the hash of the source to the metadata 
-			self.set_png_metadata(output_png_file, {"tex_hash":tex_hash})
+			# Move into the cache, the image last as its presence marks a complete
+			# entry. (Renaming within the cache directory is atomic so concurrent
+			# builds of the same snippet are harmless.)
+			for src, dst in ((pdf_file, cached_pdf_file), (img_file, cached_img_file)):
+				tmp_dst = "%s.%s.tmp"%(dst, os.path.basename(tmp_dir))
+				shutil.copy(src, tmp_dst)
+				os.rename(tmp_dst, dst)
 			
 		finally:
 			shutil.rmtree(tmp_dir)
@@ -245,16 +482,23 @@ class LaTeXBlockProcessor(BlockProcessor):
 			if "--pdf" in alt:
 				alt = alt.replace("--pdf", "").strip()
 				link_pdf = True
-				
 			
-			img = os.path.join(self.configs["latex_img_dir"], "%s.png"%(slugify(alt, "_")))
+			# Override the image format?
+			img_format = self.configs.get("latex_img_format", "png")
+			for flag_format in ("svg", "png"):
+				if "--%s"%flag_format in alt:
+					alt = alt.replace("--%s"%flag_format, "").strip()
+					img_format = flag_format
+			
+			img = os.path.join(self.configs["latex_img_dir"], "%s.%s"%(slugify(alt, "_"),
+			                                                          img_format))
 			
 			if link_pdf:
 				pdf = os.path.join(self.configs["latex_img_dir"], "%s.pdf"%(slugify(alt, "_")))
 			else:
 				pdf = None
 			
-			self.render_latex(src, img, pdf)
+			self.queue_render(src, img, pdf, img_format)
 			
 			# Add the image of the latex supplied
 			if link_pdf:
@@ -263,13 +507,37 @@ class LaTeXBlockProcessor(BlockProcessor):
 				blocks.insert(0, "![%s](file://%s)"%(alt,img))
 
 
+class LaTeXWaitTreeprocessor(Treeprocessor):
+	"""
+	Waits for the LaTeX block processor's queued renderings to complete.
+	"""
+	
+	def __init__(self, block_processor, *args, **kwargs):
+		self.block_processor = block_processor
+		Treeprocessor.__init__(self, *args, **kwargs)
+	
+	
+	def run(self, root):
+		self.block_processor.wait()
+		return root
+
+
 class LaTeX(Extension):
 	
 	def __init__(self, configs):
-		self.configs = configs
+		self.configs = dict(configs)
 	
 	def extendMarkdown(self, md, md_globals={}):
-		md.parser.blockprocessors.register(LaTeXBlockProcessor(self.configs, md.parser), 'latex', 9999)
+		self.block_processor = LaTeXBlockProcessor(self.configs, md.parser)
+		md.parser.blockprocessors.register(self.block_processor, 'latex', 9999)
+		# After inline processing but before the tree walker (priority 0) and
+		# responsive images (-10) which read the rendered images
+		md.treeprocessors.register(LaTeXWaitTreeprocessor(self.block_processor, md),
+		                           'latex_wait', 5)
+		md.registerExtension(self)
+	
+	def reset(self):
+		self.block_processor.reset()
 
 
 def makeExtension(**kwargs):
@@ -1,8 +1,38 @@
+"""
+Markdown extension for TeX math, written $...$ (inline) or $$...$$ (display).
 
+By default, math is wrapped in a <mathjax> element (delimiters included) to be
+typeset by MathJax in the reader's browser. After conversion, md.mathjax is
+True if the document contains math which must be typeset this way, including
+math within raw HTML blocks (e.g. HTML tables).
+
+With the "prerender" option, math is instead typeset into SVG at compile time
+by the MathJax command line tool given by the "command" option (by default
+tex2svg, from mathjax-node-cli). Renderings are cached in the "cache_dir"
+directory keyed by the expression, its mode and the command. Math in raw HTML
+blocks and in the abstract (md.abstract, see mdx_abstractextractor) is
+prerendered too.
+"""
 
 import markdown
 import xml.etree.ElementTree as etree
 
+from markdown.treeprocessors import Treeprocessor
+
+from subprocess import Popen, PIPE
+
+import os
+import re
+import hashlib
+import tempfile
+
+# Matches math in plain text (e.g. an abstract), with the same delimiters as
+# MathJaxPattern.
+MATH_RE = re.compile(r'(?<!\\)(\$\$?)(.+?)\1')
+
+DEFAULT_CACHE_DIR = os.environ.get("JHNET_MATHJAX_CACHE",
+                                   os.path.expanduser("~/.cache/jhnet_mathjax"))
+
 class MathJaxPattern(markdown.inlinepatterns.Pattern):
 
     def __init__(self):
@@ -13,7 +43,129 @@ class MathJaxPattern(markdown.inlinepatterns.Pattern):
         node.text = markdown.util.AtomicString(m.group(2) + m.group(3) + m.group(2))
         return node
 
+class MathJaxRenderer(object):
+    """
+    Typesets TeX math into SVG using a MathJax command line tool, caching the
+    results.
+    """
+
+    def __init__(self, command, cache_dir):
+        self.command = list(command)
+        self.cache_dir = cache_dir
+
+    def render(self, expression, display):
+        """
+        Return the SVG for the given expression (in display mode if display is
+        True, inline otherwise).
+        """
+        key = hashlib.sha1(repr((expression, display, self.command))).hexdigest()
+        cache_file = os.path.join(self.cache_dir, "%s.svg"%key)
+        try:
+            with open(cache_file, "r") as f:
+                return f.read()
+        except IOError:
+            pass
+
+        command = self.command + ([] if display else ["--inline"]) + [expression]
+        p = Popen(command, stdin = None, stdout = PIPE)
+        svg = p.communicate()[0]
+        if p.returncode != 0:
+            raise Exception("Rendering math failed for:\n%s"%expression)
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created concurrently
+                pass
+        fd, tmp_file = tempfile.mkstemp(dir = self.cache_dir, suffix = ".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(svg)
+        os.rename(tmp_file, cache_file)
+
+        return svg
+
+    def render_html(self, delimited_expression):
+        """
+        Return HTML for an expression with its $ or $$ delimiters.
+        """
+        delimiter = "$$" if delimited_expression.startswith("$$") else "$"
+        expression = delimited_expression[len(delimiter):-len(delimiter)]
+        svg = self.render(expression, delimiter == "$$")
+        if delimiter == "$$":
+            return '<span class="math" style="display:block; text-align:center;">%s</span>'%svg
+        else:
+            return '<span class="math">%s</span>'%svg
+
+    def render_text(self, text):
+        """
+        Replace all math in a snippet of HTML with its rendering.
+        """
+        return MATH_RE.sub(lambda m: self.render_html(m.group(0)), text)
+
+class RawHtmlCountTreeprocessor(Treeprocessor):
+    """
+    Runs before any treeprocessor adds to the HTML stash, recording the number of
+    entries (all raw HTML blocks, stashed by the preprocessors) in
+    md.mathjax_raw_html_blocks.
+    """
+
+    def __init__(self, md):
+        self.md = md
+
+    def run(self, root):
+        self.md.mathjax_raw_html_blocks = len(self.md.htmlStash.rawHtmlBlocks)
+        return root
+
+class MathJaxTreeprocessor(Treeprocessor):
+    """
+    Replaces <mathjax> elements and math in raw HTML blocks with their
+    prerendered form (if a renderer is given) and records whether any remain.
+    """
+
+    def __init__(self, md, renderer):
+        self.md = md
+        self.renderer = renderer
+
+    def run(self, root):
+        elements = list(root.iter('mathjax'))
+
+        # Raw HTML blocks (math in other stashed HTML, e.g. highlighted code, is
+        # not math)
+        raw_blocks = self.md.htmlStash.rawHtmlBlocks
+        raw_indices = [i for i in range(self.md.mathjax_raw_html_blocks)
+                       if isinstance(raw_blocks[i], basestring)]
+
+        if self.renderer is None:
+            self.md.mathjax = (len(elements) > 0
+                               or any(MATH_RE.search(raw_blocks[i]) is not None
+                                      for i in raw_indices))
+            return root
+
+        for element in elements:
+            html = self.renderer.render_html(element.text)
+            element.tag = 'span'
+            element.text = self.md.htmlStash.store(html)
+
+        for i in raw_indices:
+            raw_blocks[i] = self.renderer.render_text(raw_blocks[i])
+
+        if getattr(self.md, 'abstract', None) is not None:
+            self.md.abstract = self.renderer.render_text(self.md.abstract)
+
+        self.md.mathjax = False
+        return root
+
 class MathJaxExtension(markdown.Extension):
+
+    def __init__(self, **kwargs):
+        self.config = {
+            'prerender': [False, 'Typeset math at compile time'],
+            'command': [['tex2svg'], 'MathJax command line tool used to prerender math'],
+            'cache_dir': [DEFAULT_CACHE_DIR, 'Directory in which prerendered math is cached'],
+        }
+        markdown.Extension.__init__(self, **kwargs)
+
     def extendMarkdown(self, md, md_globals={}):
         # Needs to come before escape matching because \ is pretty important in LaTeX
         md.inlinePatterns.register(
@@ -22,7 +174,24 @@ class MathJaxExtension(markdown.Extension):
             md.inlinePatterns.get_index_for_name("escape") + 1
         )
 
-def makeExtension(**kwargs):
-    return MathJaxExtension(**kwargs)
+        if self.getConfig('prerender'):
+            renderer = MathJaxRenderer(self.getConfig('command'), self.getConfig('cache_dir'))
+        else:
+            renderer = None
+
+        # Before codehilite (30) and its cache (31) stash their HTML
+        md.treeprocessors.register(RawHtmlCountTreeprocessor(md), 'mathjax_rawhtml', 100)
 
+        # Runs after the abstract has been extracted
+        md.treeprocessors.register(MathJaxTreeprocessor(md, renderer), 'mathjax', -200)
 
+        self.md = md
+        md.registerExtension(self)
+        self.reset()
+
+    def reset(self):
+        self.md.mathjax = False
+        self.md.mathjax_raw_html_blocks = 0
+
+def makeExtension(**kwargs):
+    return MathJaxExtension(**kwargs)
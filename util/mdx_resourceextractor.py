@@ -8,16 +8,22 @@ not given.
 
 Returns a list of (local_path, desired_path) in md.resources where local_path is
 the path to the file on the local machine and desired_path is the new path.
+
+Each file appears only once: references to the same file (after resolving
+relative paths and symlinks) or to files with identical contents and the same
+extension share a single desired_path. (When used with mdx_latex, its rendered
+images are complete before the files are compared.)
 """
 
-from markdown.treeprocessors import Treeprocessor
-from markdown.extensions     import Extension
+from markdown.extensions import Extension
 
 import os
+import hashlib
 
-from util import unique
+from util import UniqueNames
+from mdx_treewalk import TreeVisitor, register_visitor
 
-class ResourceExtractorTreeprocessor(Treeprocessor):
+class ResourceExtractorVisitor(TreeVisitor):
 	
 	# A list of types of tags which point to resources and the attribute which
 	# contains the address of the resource.
@@ -26,45 +32,85 @@ class ResourceExtractorTreeprocessor(Treeprocessor):
 		"a":   "href",
 	}
 	
+	tags = frozenset(RESOURCE_TAGS)
+	
+	
 	def __init__(self, md, configs):
 		self.md = md
 		self.configs = configs
 	
 	
-	def remap_resources(self, root, local_file_paths = None, desired_file_names = None):
-		local_file_paths   = local_file_paths   if local_file_paths   is not None else []
-		desired_file_names = desired_file_names if desired_file_names is not None else []
-		
-		for child in root:
-			if child.tag in ResourceExtractorTreeprocessor.RESOURCE_TAGS:
-				attrib = ResourceExtractorTreeprocessor.RESOURCE_TAGS[child.tag]
-				file_path = child.attrib[attrib]
-				if file_path.startswith("file://"):
-					local_file_path = os.path.join( self.configs.get("relative_path",".")
-					                              , file_path[len("file://"):]
-					                              )
-					desired_file_name = unique(os.path.basename(local_file_path), desired_file_names)
-					
-					child.attrib[attrib] = "%s/%s"%(self.configs["resource_dir"],desired_file_name)
-					
-					local_file_paths.append(local_file_path)
-					desired_file_names.append(desired_file_name)
-			
-			# Recurse
-			self.remap_resources(child, local_file_paths, desired_file_names)
+	def start(self, root):
+		self.local_file_paths = []
+		self.desired_file_names = []
+		self.names = UniqueNames()
 		
+		# The desired file name of each resolved local path
+		self.names_by_path = {}
 		
-		# Return with the resource dirs prefixed
-		return list(zip(local_file_paths,
-		                ( "%s/%s"%(self.configs["resource_dir"], dfn)
-		                  for dfn in desired_file_names)
-		                ))
+		# The resolved local paths of the files named so far, by (lower case)
+		# extension and size, to find files with the same content without hashing
+		# every file
+		self.paths_by_type = {}
+		self.hashes = {}
+	
+	
+	def content_hash(self, path):
+		if path not in self.hashes:
+			with open(path, "rb") as f:
+				self.hashes[path] = hashlib.sha1(f.read()).hexdigest()
+		return self.hashes[path]
+	
+	
+	def find_duplicate(self, path, ext):
+		"""
+		Return the resolved path of a file already named with the given extension
+		which has the same contents as the given file, or None.
+		"""
+		try:
+			file_type = (ext.lower(), os.path.getsize(path))
+			for other_path in self.paths_by_type.get(file_type, []):
+				if self.content_hash(other_path) == self.content_hash(path):
+					return other_path
+		except (IOError, OSError):
+			# Missing files are reported when resources are copied
+			return None
 		
+		self.paths_by_type.setdefault(file_type, []).append(path)
+		return None
 	
 	
-	def run(self, root):
-		self.md.resources = self.remap_resources(root)
-		return root
+	def visit(self, element):
+		attrib = ResourceExtractorVisitor.RESOURCE_TAGS[element.tag]
+		file_path = element.attrib[attrib]
+		if file_path.startswith("file://"):
+			local_file_path = os.path.join( self.configs.get("relative_path",".")
+			                              , file_path[len("file://"):]
+			                              )
+			resolved_path = os.path.realpath(local_file_path)
+			
+			if resolved_path not in self.names_by_path:
+				duplicate_path = self.find_duplicate(
+					resolved_path, os.path.splitext(local_file_path)[1])
+				if duplicate_path is not None:
+					self.names_by_path[resolved_path] = self.names_by_path[duplicate_path]
+				else:
+					desired_file_name = self.names.allocate(os.path.basename(local_file_path))
+					self.names_by_path[resolved_path] = desired_file_name
+					
+					self.local_file_paths.append(local_file_path)
+					self.desired_file_names.append(desired_file_name)
+			
+			element.attrib[attrib] = "%s/%s"%(self.configs["resource_dir"],
+			                                  self.names_by_path[resolved_path])
+	
+	
+	def finish(self, root):
+		# Record with the resource dirs prefixed
+		self.md.resources = list(zip(self.local_file_paths,
+		                             ( "%s/%s"%(self.configs["resource_dir"], dfn)
+		                               for dfn in self.desired_file_names)
+		                             ))
 
 
 class ResourceExtractor(Extension):
@@ -73,11 +119,13 @@ class ResourceExtractor(Extension):
 		self.configs = dict(configs)
 	
 	def extendMarkdown(self, md, md_globals={}):
-		md.treeprocessors.register(
-			ResourceExtractorTreeprocessor(md, configs = self.configs),
-			'resourceextractor',
-			0,
-		)
+		self.md = md
+		md.registerExtension(self)
+		register_visitor(md, ResourceExtractorVisitor(md, configs = self.configs))
+		self.reset()
+	
+	def reset(self):
+		self.md.resources = []
 
 
 def makeExtension(**kwargs):
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Markdown extension which generates resized (and optionally re-encoded) variants
+of the local images extracted by mdx_resourceextractor so that browsers can
+download an image no larger than they will display.
+
+Each local PNG or JPEG <img> gets a srcset listing variants at each of the
+configs["widths"] narrower than the original (the original is kept as the
+largest candidate and as the src) along with configs["sizes"]. For each format
+in configs["formats"] ("webp" and/or "avif"), the <img> is wrapped in a
+<picture> with a <source> offering the same widths in that format.
+
+Variants are generated in parallel by a pool of configs["jobs"] (default: one
+per CPU) threads and are kept in a cache directory, configs["cache_dir"]
+(default: $JHNET_IMAGE_CACHE or ~/.cache/jhnet_images), named by a hash of the
+source image's content and the variant's width and format. The variants are
+added to md.resources (pointing into the cache) to be copied along with the
+other resources. Rendered LaTeX images are included: when used with mdx_latex,
+its renderings are complete before this extension runs.
+
+Resizing and WebP encoding use PIL. AVIF encoding uses avifenc (libavif).
+"""
+
+from markdown.treeprocessors import Treeprocessor
+from markdown.extensions     import Extension
+
+from multiprocessing.pool import ThreadPool
+
+from subprocess import Popen
+
+from PIL import Image
+
+import xml.etree.ElementTree as etree
+
+import multiprocessing
+import tempfile
+import hashlib
+import shutil
+import sys
+import os
+
+from util import UniqueNames
+
+
+class ResponsiveImagesTreeprocessor(Treeprocessor):
+
+	# Extensions of the images which variants are made of and the PIL format used
+	# to encode same-format variants.
+	IMAGE_FORMATS = {
+		".png":  "PNG",
+		".jpg":  "JPEG",
+		".jpeg": "JPEG",
+	}
+	
+	# MIME types of the alternative formats
+	MIME_TYPES = {
+		"webp": "image/webp",
+		"avif": "image/avif",
+	}
+	
+	DEFAULT_WIDTHS = [350, 700, 1400]
+	DEFAULT_SIZES  = "(max-width: 767px) 100vw, 700px"
+	DEFAULT_CACHE_DIR = os.environ.get("JHNET_IMAGE_CACHE",
+	                                   os.path.expanduser("~/.cache/jhnet_images"))
+	
+	# Encoder quality for lossy formats
+	QUALITY = 80
+	
+	
+	def __init__(self, md, configs):
+		self.md = md
+		self.configs = configs
+	
+	
+	def variant_file(self, source_hash, width, fmt):
+		"""
+		The cache file name for a variant of an image with the given content hash.
+		"""
+		return os.path.join(self.configs.get("cache_dir", self.DEFAULT_CACHE_DIR),
+		                    "%s_%d.%s"%(source_hash, width, fmt.lower()))
+	
+	
+	def make_variant(self, local_file, variant_file, width, fmt):
+		"""
+		Generate a variant of local_file which is width pixels wide in the format
+		given ("png", "jpeg", "webp" or "avif"), unless it is already in the cache.
+		"""
+		if os.path.isfile(variant_file):
+			return
+		
+		cache_dir = os.path.dirname(variant_file)
+		if not os.path.isdir(cache_dir):
+			try:
+				os.makedirs(cache_dir)
+			except OSError:
+				# Created concurrently
+				pass
+		
+		tmp_dir = tempfile.mkdtemp(prefix = "mdx_responsiveimages_")
+		try:
+			im = Image.open(local_file)
+			if im.mode not in ("RGB", "RGBA", "L", "LA"):
+				# E.g. palette images must be converted to be resized smoothly
+				im = im.convert("RGBA")
+			height = max(1, int(round(im.size[1] * width / float(im.size[0]))))
+			im = im.resize((width, height), Image.ANTIALIAS)
+			
+			tmp_file = os.path.join(tmp_dir, os.path.basename(variant_file))
+			if fmt == "avif":
+				# Encoded from a lossless intermediate
+				png_file = os.path.join(tmp_dir, "variant.png")
+				im.save(png_file, "PNG")
+				p = Popen( ["avifenc", png_file, tmp_file]
+				         , stdin  = None
+				         , stdout = sys.stderr
+				         , stderr = sys.stderr
+				         )
+				if p.wait() != 0:
+					raise Exception("Encoding %s as AVIF failed."%local_file)
+			elif fmt == "webp":
+				if im.mode not in ("RGB", "RGBA"):
+					im = im.convert("RGBA")
+				im.save(tmp_file, "WEBP", quality = self.QUALITY,
+				        lossless = local_file.lower().endswith(".png"))
+			elif fmt == "jpeg":
+				if im.mode != "RGB":
+					im = im.convert("RGB")
+				im.save(tmp_file, "JPEG", quality = self.QUALITY, optimize = True)
+			else:
+				im.save(tmp_file, "PNG", optimize = True)
+			
+			# Atomically add to the cache
+			tmp_cache_file = "%s.%s.tmp"%(variant_file, os.path.basename(tmp_dir))
+			shutil.move(tmp_file, tmp_cache_file)
+			os.rename(tmp_cache_file, variant_file)
+		finally:
+			shutil.rmtree(tmp_dir)
+	
+	
+	def run(self, root):
+		resources = getattr(self.md, "resources", [])
+		local_files = dict((target, local) for (local, target) in resources)
+		taken_names = UniqueNames(target.split("/")[-1] for (_, target) in resources)
+		
+		widths  = sorted(self.configs.get("widths", self.DEFAULT_WIDTHS))
+		sizes   = self.configs.get("sizes", self.DEFAULT_SIZES)
+		formats = self.configs.get("formats", [])
+		
+		# The variants to generate as (local_file, variant_file, width, format)
+		jobs = []
+		
+		# Elements to wrap in <picture> elements as (parent, img, sources)
+		pictures = []
+		
+		parents = dict((child, parent) for parent in root.iter() for child in parent)
+		for img in list(root.iter("img")):
+			target = img.get("src")
+			local_file = local_files.get(target)
+			if local_file is None:
+				continue
+			
+			ext = os.path.splitext(local_file)[1].lower()
+			if ext not in self.IMAGE_FORMATS:
+				continue
+			
+			try:
+				with open(local_file, "rb") as f:
+					source_hash = hashlib.sha1(f.read()).hexdigest()
+				original_width = Image.open(local_file).size[0]
+			except IOError:
+				# Missing files are reported when resources are copied. (LaTeX
+				# renderings are complete by now, see mdx_latex's latex_wait.)
+				continue
+			
+			resource_dir, file_name = target.rsplit("/", 1)
+			base_name = os.path.splitext(file_name)[0]
+			
+			variant_widths = [w for w in widths if w < original_width]
+			if not variant_widths:
+				continue
+			
+			def add_variants(fmt, ext):
+				srcset = []
+				for width in variant_widths:
+					variant_file = self.variant_file(source_hash, width, fmt)
+					name = taken_names.allocate("%s.%dw%s"%(base_name, width, ext))
+					resources.append((variant_file, "%s/%s"%(resource_dir, name)))
+					jobs.append((local_file, variant_file, width, fmt))
+					srcset.append("%s/%s %dw"%(resource_dir, name, width))
+				return srcset
+			
+			srcset = add_variants(self.IMAGE_FORMATS[ext].lower(), ext)
+			srcset.append("%s %dw"%(target, original_width))
+			img.set("srcset", ", ".join(srcset))
+			img.set("sizes", sizes)
+			
+			sources = []
+			for fmt in formats:
+				srcset = add_variants(fmt, ".%s"%fmt)
+				source = etree.Element("source")
+				source.set("type", self.MIME_TYPES[fmt])
+				source.set("srcset", ", ".join(srcset))
+				source.set("sizes", sizes)
+				sources.append(source)
+			
+			if sources:
+				pictures.append((parents[img], img, sources))
+		
+		# Wrap images in <picture>s, keeping their position (and tail text)
+		for parent, img, sources in pictures:
+			index = list(parent).index(img)
+			picture = etree.Element("picture")
+			picture.tail = img.tail
+			img.tail = None
+			for source in sources:
+				picture.append(source)
+			parent.remove(img)
+			picture.append(img)
+			parent.insert(index, picture)
+		
+		# Generate any variants not already in the cache
+		if jobs:
+			pool = ThreadPool(self.configs.get("jobs") or multiprocessing.cpu_count())
+			try:
+				results = [pool.apply_async(self.make_variant, job) for job in jobs]
+				for result in results:
+					result.get()
+			finally:
+				pool.close()
+				pool.join()
+		
+		return root
+
+
+class ResponsiveImages(Extension):
+
+	def __init__(self, configs):
+		self.configs = dict(configs)
+	
+	def extendMarkdown(self, md, md_globals={}):
+		# Must run after the resource extractor (priority 0) and after the LaTeX
+		# renderings have been waited for (mdx_latex's latex_wait, priority 5)
+		md.treeprocessors.register(
+			ResponsiveImagesTreeprocessor(md, configs = self.configs),
+			'responsiveimages',
+			-10,
+		)
+
+
+def makeExtension(**kwargs):
+	return ResponsiveImages(kwargs.get("configs", {}))
@@ -4,33 +4,32 @@
 Markdown extension which does toc extraction.
 """
 
-from markdown.treeprocessors import Treeprocessor
-from markdown.extensions     import Extension
+from markdown.extensions import Extension
 
-from util import unique, slugify
+from util import UniqueNames, slugify
+from mdx_treewalk import TreeVisitor, register_visitor
 
-class ToCExtractorTreeprocessor(Treeprocessor):
+class ToCExtractorVisitor(TreeVisitor):
 	
-	HEADINGS = ["h%d"%level for level in range(1,7)]
+	HEADINGS = frozenset("h%d"%level for level in range(1,7))
+	
+	tags = HEADINGS
 	
 	
 	def __init__(self, md):
 		self.md = md
 	
 	
-	def get_headings(self, root):
-		headings = []
-		
-		for child in root:
-			if child.tag in ToCExtractorTreeprocessor.HEADINGS:
-				headings.append(child)
-			
-			headings.extend(self.get_headings(child))
-		
-		return headings
+	def start(self, root):
+		self.headings = []
+	
+	
+	def visit(self, element):
+		self.headings.append(element)
 	
 	
 	def allocate_anchors(self, headings):
+		names = UniqueNames()
 		ids = []
 		labels = []
 		levels = []
@@ -38,7 +37,7 @@ class ToCExtractorTreeprocessor(Treeprocessor):
 		for heading in headings:
 			heading_text = "".join(heading.itertext())
 			# Pick an ID
-			id = unique(slugify(heading_text, "-"), ids)
+			id = names.allocate(slugify(heading_text, "-"))
 			
 			# Assign the ID to the heading
 			heading.attrib["id"] = id
@@ -51,10 +50,8 @@ class ToCExtractorTreeprocessor(Treeprocessor):
 		return list(zip(levels, labels, ids))
 	
 	
-	def run(self, root):
-		headings = self.get_headings(root)
-		self.md.toc = self.allocate_anchors(headings)
-		return root
+	def finish(self, root):
+		self.md.toc = self.allocate_anchors(self.headings)
 
 
 class ToCExtractor(Extension):
@@ -63,7 +60,13 @@ class ToCExtractor(Extension):
 		pass
 	
 	def extendMarkdown(self, md, md_globals={}):
-		md.treeprocessors.register(ToCExtractorTreeprocessor(md), 'tocextractor', 0)
+		self.md = md
+		md.registerExtension(self)
+		register_visitor(md, ToCExtractorVisitor(md))
+		self.reset()
+	
+	def reset(self):
+		self.md.toc = []
 
 
 def makeExtension(**kwargs):
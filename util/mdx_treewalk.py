@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+A single shared pass over the ElementTree of a document for the extractor
+extensions.
+
+Rather than each extension recursively walking the whole tree in its own
+treeprocessor, extensions register a TreeVisitor with register_visitor(md,
+visitor). A single treeprocessor then walks the tree once, iteratively (in
+document order, i.e. pre-order, not including the root), passing every element
+to every visitor.
+"""
+
+from markdown.treeprocessors import Treeprocessor
+
+
+class TreeVisitor(object):
+	"""
+	Base class for visitors. start() is called before the walk, visit() for each
+	element whose tag is in tags (or every element if tags is None) and finish()
+	after the walk.
+	"""
+	
+	tags = None
+	
+	
+	def start(self, root):
+		pass
+	
+	
+	def visit(self, element):
+		pass
+	
+	
+	def finish(self, root):
+		pass
+
+
+class TreeWalkerTreeprocessor(Treeprocessor):
+	
+	def __init__(self, md):
+		self.md = md
+		self.visitors = []
+	
+	
+	def run(self, root):
+		visitors = self.visitors
+		
+		for visitor in visitors:
+			visitor.start(root)
+		
+		# The visitors of each tag of interest and of all other tags, so that each
+		# element costs a single lookup
+		every = [v for v in visitors if v.tags is None]
+		by_tag = {}
+		for tag in set(tag for v in visitors for tag in (v.tags or ())):
+			by_tag[tag] = [v for v in visitors if v.tags is None or tag in v.tags]
+		
+		# The elements yet to be visited, next last
+		stack = root[::-1]
+		while stack:
+			element = stack.pop()
+			for visitor in by_tag.get(element.tag, every):
+				visitor.visit(element)
+			stack.extend(element[::-1])
+		
+		for visitor in visitors:
+			visitor.finish(root)
+		
+		return root
+
+
+def register_visitor(md, visitor):
+	"""
+	Add a TreeVisitor to the shared walk of the given Markdown instance's tree,
+	registering the walker's treeprocessor if this is the first.
+	"""
+	if "treewalker" not in md.treeprocessors:
+		md.treeprocessors.register(TreeWalkerTreeprocessor(md), 'treewalker', 0)
+	md.treeprocessors['treewalker'].visitors.append(visitor)
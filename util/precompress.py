@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Generates precompressed "sidecar" versions of static files which the site sends
+in place of the originals to clients which accept them.
+
+Usage:
+
+	precompress.py [--clean] directory [directory ...]
+	
+	For every compressible file (by extension) in the given directories, writes
+	[file].gz and, if the brotli module is installed, [file].br alongside it.
+	Sidecars which are already up to date are left alone and sidecars which
+	would not be smaller than the original are not kept. With --clean, all
+	sidecars are removed instead.
+"""
+
+import os
+import sys
+import gzip
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Extensions of files worth compressing (already-compressed formats such as
+# images and archives are skipped).
+COMPRESSIBLE_EXTENSIONS = set([
+	".css", ".js", ".html", ".htm", ".svg", ".txt", ".json", ".xml", ".csv",
+	".md", ".tex", ".toc", ".eot", ".ttf", ".otf", ".ico",
+])
+
+# Files smaller than this are not worth compressing
+MIN_SIZE = 256
+
+SIDECAR_SUFFIXES = (".gz", ".br")
+
+
+def write_gzip(data, output_file_name):
+	# The mtime is fixed so that regenerating a file gives identical output
+	with open(output_file_name, "wb") as f:
+		gz = gzip.GzipFile(filename = "", mode = "wb", compresslevel = 9,
+		                   fileobj = f, mtime = 0)
+		gz.write(data)
+		gz.close()
+
+
+def write_brotli(data, output_file_name):
+	with open(output_file_name, "wb") as f:
+		f.write(brotli.compress(data, quality = 11))
+
+
+def compressors():
+	"""
+	Returns a list of (suffix, write_function) pairs for the available formats.
+	"""
+	formats = [(".gz", write_gzip)]
+	if brotli is not None:
+		formats.append((".br", write_brotli))
+	return formats
+
+
+def precompress_file(file_name):
+	"""
+	Generate any missing or out-of-date sidecars for the given file. Returns the
+	list of sidecars written.
+	"""
+	written = []
+	data = None
+	mtime = os.path.getmtime(file_name)
+	size  = os.path.getsize(file_name)
+	
+	for suffix, write in compressors():
+		sidecar = file_name + suffix
+		if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= mtime:
+			continue
+		
+		if data is None:
+			with open(file_name, "rb") as f:
+				data = f.read()
+		
+		write(data, sidecar)
+		if os.path.getsize(sidecar) >= size:
+			# Compression didn't help
+			os.remove(sidecar)
+		else:
+			written.append(sidecar)
+	
+	return written
+
+
+def walk_files(directory):
+	"""
+	Generate the names of all (non-sidecar) files under a directory.
+	"""
+	for dir_path, dir_names, file_names in os.walk(directory):
+		for file_name in file_names:
+			if not file_name.endswith(SIDECAR_SUFFIXES):
+				yield os.path.join(dir_path, file_name)
+
+
+def precompress(directory):
+	"""
+	Generate sidecars for all compressible files in a directory.
+	"""
+	for file_name in walk_files(directory):
+		ext = os.path.splitext(file_name)[1].lower()
+		if ext in COMPRESSIBLE_EXTENSIONS and os.path.getsize(file_name) >= MIN_SIZE:
+			for sidecar in precompress_file(file_name):
+				print sidecar
+
+
+def clean(directory):
+	"""
+	Remove all sidecars from a directory.
+	"""
+	for dir_path, dir_names, file_names in os.walk(directory):
+		for file_name in file_names:
+			original = os.path.join(dir_path, file_name)
+			for suffix in SIDECAR_SUFFIXES:
+				if os.path.isfile(original + suffix):
+					os.remove(original + suffix)
+
+
+if __name__=="__main__":
+	args = sys.argv[1:]
+	
+	action = precompress
+	if args and args[0] == "--clean":
+		action = clean
+		args = args[1:]
+	
+	if not args:
+		sys.stderr.write(__doc__)
+		sys.exit(1)
+	
+	if brotli is None and action is precompress:
+		sys.stderr.write("WARNING: brotli module not installed, only generating .gz files\n")
+	
+	for directory in args:
+		action(directory)
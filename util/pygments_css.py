@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""
+The Pygments style used for code highlighted by the publication compiler (see
+mdx_highlightcache.py) and a generator for its stylesheet.
+
+Usage:
+
+	pygments_css.py [output_file]
+	
+	Writes the CSS to output_file (atomically) or to stdout if none is given.
+	update.sh (also run by setup.sh) writes static/css/pygments.css, as used
+	by the publication templates. Requires Pygments (but not markdown).
+"""
+
+import os
+import sys
+
+# The Pygments style and CSS class used to highlight code
+STYLE = "default"
+CSS_CLASS = "codehilite"
+
+
+def style_css(style = STYLE, css_class = CSS_CLASS):
+	"""
+	The CSS for code highlighted with the given Pygments style and CSS class.
+	"""
+	from pygments.formatters import HtmlFormatter
+	return HtmlFormatter(style = style).get_style_defs(".%s"%css_class)
+
+
+if __name__=="__main__":
+	css = style_css() + "\n"
+	
+	if len(sys.argv) > 1:
+		output_file = sys.argv[1]
+		with open(output_file + ".tmp", "w") as f:
+			f.write(css)
+		os.rename(output_file + ".tmp", output_file)
+	else:
+		sys.stdout.write(css)
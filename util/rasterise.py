@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Conversion of PDFs (e.g. rendered LaTeX) into PNGs and SVGs.
+
+Several PNG backends are supported, in order of preference:
+
+	pdftocairo -- (poppler) renders directly at the target resolution with
+	              antialiasing and a transparent background.
+	pdftoppm   -- (poppler) as above but with a white background.
+	convert    -- (ImageMagick/Ghostscript) renders at OVERSAMPLE times the
+	              target resolution and scales down (slow).
+
+For SVGs, the backends are (in order of preference):
+
+	dvisvgm    -- converts text to paths and optimises the output (requires
+	              dvisvgm 2.7 or later built with PDF support).
+	pdftocairo -- (poppler)
+	pdf2svg    -- (poppler/cairo)
+
+The first backend whose program is installed (and, for dvisvgm, supports PDF
+input according to "dvisvgm --help") is used unless one is named explicitly.
+
+Text metadata is added to PNGs by inserting tEXt chunks into the file directly,
+rather than decoding and re-encoding the image.
+"""
+
+import os
+import sys
+import zlib
+import struct
+
+from distutils.spawn import find_executable
+
+from subprocess import Popen, PIPE
+
+# Factor by which the convert backend oversamples
+OVERSAMPLE = 4
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+
+def run(command):
+	"""
+	Run the given command, sending its output to stderr and raising an exception
+	if it fails.
+	"""
+	p = Popen( command
+	         , stdin  = None
+	         , stdout = sys.stderr
+	         , stderr = sys.stderr
+	         )
+	if p.wait() != 0:
+		raise Exception("%s failed."%command[0])
+
+
+def pdftocairo(pdf_file, png_file, dpi):
+	run([ "pdftocairo", "-png", "-singlefile", "-transparent"
+	    , "-r", str(dpi)
+	    , pdf_file, os.path.splitext(png_file)[0]])
+
+
+def pdftoppm(pdf_file, png_file, dpi):
+	run([ "pdftoppm", "-png", "-singlefile"
+	    , "-r", str(dpi)
+	    , pdf_file, os.path.splitext(png_file)[0]])
+
+
+def convert(pdf_file, png_file, dpi):
+	run([ "convert"
+	    , "-density", str(dpi * OVERSAMPLE)
+	    , pdf_file
+	    , "-resize", "%d%%"%(100 / OVERSAMPLE)
+	    , png_file])
+
+
+def dvisvgm(pdf_file, svg_file):
+	run([ "dvisvgm", "--pdf", "--no-fonts", "--optimize"
+	    , "--output=%s"%svg_file
+	    , pdf_file])
+
+
+# Whether the installed dvisvgm supports PDF input (None until probed)
+dvisvgm_pdf_support = None
+
+def dvisvgm_supports_pdf():
+	"""
+	Whether the installed dvisvgm accepts PDFs (--pdf), which requires version 2.7
+	or later built with Ghostscript support.
+	"""
+	global dvisvgm_pdf_support
+	if dvisvgm_pdf_support is None:
+		try:
+			p = Popen(["dvisvgm", "--help"], stdin = None, stdout = PIPE, stderr = PIPE)
+			stdout, _ = p.communicate()
+			dvisvgm_pdf_support = "--pdf" in stdout
+		except OSError:
+			dvisvgm_pdf_support = False
+	return dvisvgm_pdf_support
+
+
+def pdftocairo_svg(pdf_file, svg_file):
+	run(["pdftocairo", "-svg", pdf_file, svg_file])
+
+
+def pdf2svg(pdf_file, svg_file):
+	run(["pdf2svg", pdf_file, svg_file])
+
+
+# (name, function(pdf_file, png_file, dpi)) for each backend in order of
+# preference. The name is that of the program required. png_file must end in
+# ".png".
+BACKENDS = [
+	("pdftocairo", pdftocairo),
+	("pdftoppm",   pdftoppm),
+	("convert",    convert),
+]
+
+# (name, function(pdf_file, svg_file)) for each SVG backend in order of
+# preference.
+SVG_BACKENDS = [
+	("dvisvgm",    dvisvgm),
+	("pdftocairo", pdftocairo_svg),
+	("pdf2svg",    pdf2svg),
+]
+
+
+# Functions of backends whose programs may be installed without the support
+# needed, with a function returning whether it is present.
+PROBES = {
+	dvisvgm: dvisvgm_supports_pdf,
+}
+
+
+def usable(backend_name, function):
+	return (find_executable(backend_name) is not None
+	        and PROBES.get(function, lambda: True)())
+
+
+def get_backend(name = None, backends = BACKENDS, kind = "rasteriser"):
+	"""
+	Return the (name, function) of the named backend or, if no name is given, the
+	first usable backend in the list of backends given. kind names the type of
+	backend in error messages (e.g. "SVG converter").
+	"""
+	for backend_name, function in backends:
+		if name is None and usable(backend_name, function):
+			return (backend_name, function)
+		elif name == backend_name:
+			return (backend_name, function)
+	
+	if name is None:
+		raise Exception("None of %s are installed (and usable)."%(
+			", ".join(backend_name for backend_name, _ in backends)))
+	else:
+		raise Exception("Unknown %s '%s'."%(kind, name))
+
+
+def png_chunk(chunk_type, data):
+	return (struct.pack(">I", len(data))
+	        + chunk_type + data
+	        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+
+def set_png_text(png_file, metadata):
+	"""
+	Set the given text fields (a dict) in the metadata of a PNG file, replacing
+	any existing fields with the same names.
+	"""
+	with open(png_file, "rb") as f:
+		data = f.read()
+	
+	if not data.startswith(PNG_SIGNATURE):
+		raise Exception("%s is not a PNG."%png_file)
+	
+	chunks = []
+	pos = len(PNG_SIGNATURE)
+	while pos < len(data):
+		length, = struct.unpack(">I", data[pos:pos + 4])
+		chunk_type = data[pos + 4:pos + 8]
+		chunk_data = data[pos + 8:pos + 8 + length]
+		end = pos + 12 + length
+		
+		if chunk_type == "IEND":
+			# Add the new fields before the end of the image
+			for key, value in sorted(metadata.iteritems()):
+				chunks.append(png_chunk("tEXt", "%s\0%s"%(key, value)))
+			chunks.append(data[pos:end])
+		elif not (chunk_type == "tEXt" and chunk_data.split("\0", 1)[0] in metadata):
+			chunks.append(data[pos:end])
+		
+		pos = end
+	
+	with open(png_file, "wb") as f:
+		f.write(PNG_SIGNATURE)
+		f.write("".join(chunks))
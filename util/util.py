@@ -15,15 +15,47 @@ def slugify(value, separator):
 	return re.sub('[%s\s]+' % separator, separator, value)
 
 
+class UniqueNames(object):
+	"""
+	Allocates names which do not clash with each other or with an initial
+	collection of taken names, choosing the same names as successive calls to
+	unique() would. The taken names are kept in a set along with the next "%d_"
+	prefix to try for each base name so allocating a name takes amortised
+	constant time.
+	"""
+	
+	def __init__(self, taken_names = ()):
+		self.taken_names = set(taken_names)
+		self.counters = {}
+	
+	
+	def __contains__(self, name):
+		return name in self.taken_names
+	
+	
+	def allocate(self, base_name):
+		"""
+		Returns base_name or base_name prefixed with "%d_" which ensures it is not
+		taken and marks it as taken.
+		"""
+		given_name = base_name
+		if given_name in self.taken_names:
+			# Names are never freed so all prefixes before the counter are still taken
+			cnt = self.counters.get(base_name, 1)
+			given_name = "%d_%s"%(cnt, base_name)
+			while given_name in self.taken_names:
+				cnt += 1
+				given_name = "%d_%s"%(cnt, base_name)
+			self.counters[base_name] = cnt + 1
+		
+		self.taken_names.add(given_name)
+		return given_name
+
+
 def unique(base_name, taken_names):
 	"""
 	Returns base_name or base_name prefixed with "%d_" which ensures it does not
-	appear in taken_names.
+	appear in taken_names. (To allocate many names, use UniqueNames.)
 	"""
-	given_name = base_name
-	cnt = 1
-	while given_name in taken_names:
-		given_name = "%d_%s"%(cnt, base_name)
-		cnt += 1
-	return given_name
+	return UniqueNames(taken_names).allocate(base_name)
 